@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Benchmarks for the rule engine and the serialization hot paths. Every
+benchmark runs on synthetic boards of several sizes and blob shapes:
+
+    compact      both players own a solid half of the board
+    snake        one player is a single serpentine path over the whole board
+    interleaved  the players own alternating rows, like the teeth of two combs,
+                 so nearly every field touches the enemy
+
+The state codecs are compared on boards from real matches instead: the last
+matches in --history (match.db of a server), or games played here between
+simulate.py's bots if that file doesn't exist. Matches on boards larger than
+DENSE_BOARD_SIZE are left out.
+
+Results are written as JSON; pass an earlier result file with --compare to
+see the change per benchmark:
+
+    python benchmark.py --sizes 64 256 --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+from twisted.internet.testing import StringTransport
+
+from blobs import Board, Match, MatchHistory, Player, Spectator, Turn, User, FOOD_OWNER, FOOD_ABUNDANCE, MIN_PID, \
+    DENSE_BOARD_SIZE, stateCodec
+from simulate import foodBot, randomBot
+
+PLAYER_A = MIN_PID + 1
+PLAYER_B = MIN_PID + 2
+SHAPES = ["compact", "snake", "interleaved"]
+SIZES = [64, 128, 256, 512, 1024]
+CODECS = ["none", "zlib:1", "zlib:6", "zlib:9"]
+
+
+def makeBoard(size, shape, seed=0):
+    """
+    Builds a board with players PLAYER_A and PLAYER_B of strength 2 in the
+    given shape and some food on the free fields.
+    """
+    rng = np.random.RandomState(seed)
+    owner = np.zeros((size, size), dtype=np.uint16)
+    half = size // 2
+    if shape == "compact":
+        owner[:half, :half] = PLAYER_A
+        owner[half:, :half] = PLAYER_B
+    elif shape == "snake":
+        owner[::2, :-1] = PLAYER_A
+        for row in range(1, size - 1, 2):
+            owner[row, size - 2 if row % 4 == 1 else 0] = PLAYER_A
+        owner[:, -1] = PLAYER_B
+    elif shape == "interleaved":
+        owner[::2, :-1] = PLAYER_A
+        owner[1::2, 1:] = PLAYER_B
+        owner[1::2, 0] = PLAYER_A
+        owner[::2, -1] = PLAYER_B
+    else:
+        raise ValueError("unknown shape '{}'".format(shape))
+    values = np.where(owner != 0, 2, 0).astype(np.uint16)
+    free = np.argwhere(owner == 0)
+    if len(free):
+        food = free[rng.choice(len(free), int(len(free) * FOOD_ABUNDANCE), replace=False)]
+        owner[food[:, 0], food[:, 1]] = FOOD_OWNER
+        values[food[:, 0], food[:, 1]] = 1
+    return fillBoard(Board(size, rng), values, owner)
+
+
+def fillBoard(board, values, owner):
+    """
+    Copies dense arrays into a board, which may store its fields sparsely.
+    owner holds player ids, the board gets their slots.
+    """
+    board.addPlayer(PLAYER_A)
+    board.addPlayer(PLAYER_B)
+    fields = owner.nonzero()
+    board.owner[fields] = board.slotsOf(owner[fields])
+    board.values[fields] = values[fields]
+    board.relabel()
+    return board
+
+
+def makeSplitBoard(size):
+    """
+    PLAYER_B owns two blocks joined by a single field, PLAYER_A can take that
+    field from (bridge_row, 1). The smaller block, a quarter of the board, is
+    removed by the split.
+    """
+    owner = np.zeros((size, size), dtype=np.uint16)
+    bridge = size // 2
+    owner[:bridge, :size // 2] = PLAYER_B
+    owner[bridge + 1:, :size // 2] = PLAYER_B
+    owner[bridge, 0] = PLAYER_B
+    owner[bridge, 1:] = PLAYER_A
+    values = (owner != 0).astype(np.uint16)
+    values[bridge, 1] = 10
+    board = fillBoard(Board(size), values, owner)
+    return board, Turn((bridge, 1), (bridge, 0), Player(PLAYER_A, "a"))
+
+
+def makeMatch(board):
+    return Match([Player(PLAYER_A, "a"), Player(PLAYER_B, "b")], board)
+
+
+def sourceAndDest(board):
+    """
+    A field of PLAYER_A in the middle of its blob and an allied neighbor.
+    """
+    slot = board.slotOf(PLAYER_A)
+    fields = np.argwhere(board.owner == slot)
+    for x, y in fields[len(fields) // 2:]:
+        for dest in board.neighbors((x, y)):
+            if board.owner[dest] == slot:
+                return (int(x), int(y)), dest
+
+
+def perCall(fn, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number, number
+
+
+def benchFight(size, repeat):
+    """
+    Times execTurn() for an attack that splits off a large component. Every
+    run needs a fresh board, which is built outside the timed part.
+    """
+    best = None
+    for run in range(repeat):
+        board, turn = makeSplitBoard(size)
+        match = makeMatch(board)
+        start = time.perf_counter()
+        match.execTurn(turn)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, 1
+
+
+def connect(protocol, binary):
+    protocol.makeConnection(StringTransport())
+    if binary:
+        protocol.switchToBinary(False)
+    return protocol
+
+
+def benchmarks(board, repeat):
+    """
+    Yields (name, measure) for everything that runs on a board of one shape,
+    where measure() returns (seconds per call, calls per run).
+    """
+    match = makeMatch(board)
+    source, dest = sourceAndDest(board)
+    player = match.users[0]
+    slot = board.slotOf(PLAYER_A)
+
+    yield "Board.connected", lambda: perCall(lambda: board.connected(source), repeat)
+    yield "Board.playerContiguous", lambda: perCall(lambda: board.playerContiguous(slot), repeat)
+
+    def checkTurn():
+        # a field of strength 1 leaving takes the full path including the split check
+        board.values[source] = 1
+        try:
+            return perCall(lambda: match.checkTurn(Turn(source, dest, player)), repeat)
+        finally:
+            board.values[source] = 2
+    yield "Match.checkTurn", checkTurn
+    yield "Board.legalMoves[one source]", lambda: perCall(lambda: board.legalMoves(slot, [source]), repeat)
+
+    def execTurn():
+        # moving one unit forth and back leaves the board as it was
+        there, back = Turn(source, dest, player), Turn(dest, source, player)
+        seconds, number = perCall(lambda: (match.execTurn(there), match.execTurn(back)), repeat)
+        board.trimChanges(board.revision())
+        return seconds / 2, number * 2
+    yield "Match.execTurn", execTurn
+
+    yield "Match.checkMatchFinished", lambda: perCall(match.checkMatchFinished, repeat)
+
+    state = MatchHistory.encodeState(board.values, board.owner, board.slot_ids)
+    yield "MatchHistory.encodeState", lambda: perCall(lambda: MatchHistory.encodeState(board.values, board.owner, board.slot_ids), repeat)
+    yield "MatchHistory.decodeState", lambda: perCall(lambda: MatchHistory.decodeState(board.size, state), repeat)
+
+    for binary in (False, True):
+        suffix = "[binary]" if binary else "[json]"
+
+        user = connect(User(PLAYER_A, ("benchmark", 0), None), binary)
+        user.currentMatch = match
+        def askTurn(user=user):
+            user.askTurn()
+            user.transport.clear()
+        yield "User.askTurn" + suffix, lambda askTurn=askTurn: perCall(askTurn, repeat)
+
+        spectator = connect(Spectator(None, ("benchmark", 0)), binary)
+        spectator.watched[match] = 0
+        def sendActiveMatch(spectator=spectator):
+            spectator.sendActiveMatch(match)
+            spectator.transport.clear()
+        yield "Spectator.sendActiveMatch" + suffix, lambda send=sendActiveMatch: perCall(send, repeat)
+
+
+def recordGame(size, seed):
+    """
+    Plays foodBot against randomBot and returns the match history.
+    """
+    rng = np.random.RandomState(seed)
+    players = [Player(PLAYER_A, "food"), Player(PLAYER_B, "random")]
+    bots = {PLAYER_A: foodBot, PLAYER_B: randomBot}
+    board = Board(size, rng)
+    board.populate(players)
+    match = Match(players, board)
+    while True:
+        player = match.currentUser
+        move = bots[player.connection_id](board, board.slotOf(player.connection_id), rng)
+        if move is None:
+            player.consecutive_failed_turns += 1
+            match.skippedTurn()
+        else:
+            ok, message = match.checkedTurn(Turn(move[0], move[1], player))
+            player.consecutive_failed_turns = 0 if ok else player.consecutive_failed_turns + 1
+        if match.checkMatchFinished()[0]:
+            break
+        match.nextUser()
+    return match.history
+
+
+def loadHistories(filename, count):
+    """
+    Returns the dense board histories among the last count matches stored in
+    filename. The file is read backwards, only as far as those lines go.
+    """
+    chunks = []
+    newlines = 0
+    with open(filename, "rb") as f:
+        start = f.seek(0, os.SEEK_END)
+        while start > 0 and newlines <= count:
+            step = min(start, 2**20)
+            start -= step
+            f.seek(start)
+            chunks.append(f.read(step))
+            newlines += chunks[-1].count(b"\n")
+    lines = b"".join(reversed(chunks)).splitlines()[-count:]
+    histories = []
+    for line in lines:
+        try:
+            histories.append(json.loads(line.decode("utf8")))
+        except ValueError:
+            pass
+    # states of large boards would be rebuilt as dense arrays of up to 32 MB each
+    return [h for h in histories if h.get("turns") and h["board_size"] <= DENSE_BOARD_SIZE]
+
+
+def historyStates(histories, per_match):
+    """
+    Rebuilds up to per_match boards spread over each match and returns them
+    as {board size: [(values, owner), ...]}.
+    """
+    states = {}
+    for history in histories:
+        seek_index = MatchHistory.buildSeekIndex(history)
+        turns = sorted(set(np.linspace(0, len(history["turns"]) - 1, per_match).astype(int)))
+        for turn in turns:
+            states.setdefault(history["board_size"], []).append(MatchHistory.stateAt(history, turn, seek_index))
+    return states
+
+
+def codecBenchmarks(states, codec, repeat):
+    """
+    Yields (name, measure, bytes per state) for encoding and decoding the
+    given states of one board size with a codec, timed per state.
+    """
+    size = states[0][0].shape[0]
+    encoded = [MatchHistory.encodeState(values, owner, codec=codec) for values, owner in states]
+    length = sum(len(e) for e in encoded) / len(encoded)
+
+    def encode():
+        seconds, number = perCall(lambda: [MatchHistory.encodeState(v, o, codec=codec) for v, o in states], repeat)
+        return seconds / len(states), number * len(states)
+    yield "codec[{}].encodeState".format(codec.spec), encode, length
+
+    def decode():
+        seconds, number = perCall(lambda: [MatchHistory.decodeState(size, e, codec) for e in encoded], repeat)
+        return seconds / len(states), number * len(states)
+    yield "codec[{}].decodeState".format(codec.spec), decode, length
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, shapes, repeat, seed, only=None, histories=None):
+    results = []
+    def record(name, size, shape, measure, encoded_bytes=None):
+        if only and not any(o in name for o in only):
+            return
+        seconds, number = measure()
+        result = {"benchmark": name, "size": size, "shape": shape, "seconds_per_call": seconds, "calls": number}
+        line = "{:<36} {:>5} {:<12} {:>12.3f} µs".format(name, size, shape, seconds * 1e6)
+        if encoded_bytes is not None:
+            result["bytes"] = encoded_bytes
+            line += " {:>10.0f} B".format(encoded_bytes)
+        results.append(result)
+        print(line, file=sys.stderr)
+
+    for size in sizes:
+        for shape in shapes:
+            board = makeBoard(size, shape, seed)
+            for name, measure in benchmarks(board, repeat):
+                record(name, size, shape, measure)
+        record("Match.execFight[split]", size, "split", lambda: benchFight(size, repeat))
+    for size, states in sorted((histories or {}).items()):
+        for spec in CODECS:
+            for name, measure, length in codecBenchmarks(states, stateCodec(spec), repeat):
+                record(name, size, "history", measure, length)
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": gitRevision(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "repeat": repeat,
+            "seed": seed
+        },
+        "results": results
+    }
+
+
+def compare(report, previous):
+    before = dict(((r["benchmark"], r["size"], r["shape"]), r["seconds_per_call"]) for r in previous["results"])
+    for r in report["results"]:
+        key = (r["benchmark"], r["size"], r["shape"])
+        if key in before:
+            print("{:<36} {:>5} {:<12} {:>7.2f}x".format(
+                r["benchmark"], r["size"], r["shape"], r["seconds_per_call"] / before[key]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Blobs rule engine and serialization benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=SHAPES)
+    parser.add_argument("--only", nargs="+", help="run benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark, the fastest one counts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="earlier result file; prints time now / time then")
+    parser.add_argument("--history", default="match.db", help="match histories for the codec benchmarks")
+    parser.add_argument("--history-matches", type=int, default=3,
+                        help="matches to take from --history, or to play if it doesn't exist")
+    parser.add_argument("--history-states", type=int, default=20, help="boards to rebuild per match")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    names = ["codec[{}].{}".format(stateCodec(spec).spec, f) for spec in CODECS for f in ("encodeState", "decodeState")]
+    histories = []
+    if args.only and not any(o in name for name in names for o in args.only):
+        pass  # no codec benchmark selected
+    elif os.path.exists(args.history):
+        histories = loadHistories(args.history, args.history_matches)
+    else:
+        # games on large boards take too long to play here
+        histories = [recordGame(size, args.seed + i) for size in args.sizes if size <= 128
+                     for i in range(args.history_matches)]
+    states = historyStates(histories, args.history_states)
+    report = run(args.sizes, args.shapes, args.repeat, args.seed, args.only, states)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
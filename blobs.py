@@ -2,35 +2,356 @@
 # -*- coding: UTF-8 -*-
 
 import sys
+import abc
 import matplotlib.pyplot as plt
 import numpy as np
 import json
 import zlib
 import logging
 import binascii
-from twisted.internet import protocol, reactor, endpoints
+import bisect
+import itertools
+import mmap
+import os
+import sqlite3
+import pickle
+import random
+import argparse
+import time
+from collections import deque, OrderedDict
+from twisted.internet import protocol, reactor, endpoints, defer, task
+from twisted.protocols import basic
+from twisted.web import resource, server
+import wire
 
 NO_OWNER = 0
 FOOD_OWNER = 1
 MIN_PID = 1000
+# boards store owners as slots: NO_OWNER, FOOD_OWNER, then one per player from this on
+FIRST_PLAYER_SLOT = 2
+MAX_PLAYER_SLOT = 255
 PLAYERS_IN_MATCH = 2
 BOARD_SIZE = 64
+# board sizes a user can ask for at login
+MIN_BOARD_SIZE = 8
+MAX_BOARD_SIZE = 4096
+# boards up to this size are plain arrays, larger ones only store populated fields
+DENSE_BOARD_SIZE = 512
 FOOD_ABUNDANCE = 0.01
 MAX_ROUNDS = 5000
 MAX_CONSECUTIVE_FAILS = 100
+# seconds a user has to answer your_turn before the turn counts as failed, None for no limit
+TURN_TIMEOUT = 10.0
+# a user whose turns time out this many times in a row forfeits the match
+MAX_CONSECUTIVE_TIMEOUTS = 3
+# if set, a chess clock: total seconds a user may think during a match before forfeiting
+MATCH_TIME_BUDGET = None
+# every n-th turn of a match history is a full snapshot, the others are deltas
+# (large boards take snapshots by size instead, see Match.addStateToHistory())
+KEYFRAME_INTERVAL = 100
+# largest request (JSON line or binary frame) accepted from a client, in bytes
+MAX_MESSAGE_SIZE = 65536
+# upper bound for the encoded size of historic matches kept in memory, in bytes
+MATCH_CACHE_SIZE = 64 * 2**20
+# a match history checkpoint is only used if these many bytes before its end still match
+CHECKPOINT_TAIL = 4096
+# user store changes are committed in batches, at most this many seconds late
+COMMIT_INTERVAL = 1.0
+# Elo rating of new users and the most a rating changes in one match
+INITIAL_RATING = 1500.0
+ELO_K = 32
+# leaderboard entries per get_leaderboard page, by default and at most
+LEADERBOARD_PAGE_SIZE = 20
+MAX_LEADERBOARD_PAGE_SIZE = 100
+# if set, only users whose scores fall into the same band of this width are paired
+MATCHMAKING_BAND = None
+# default frame rate limit per match for spectators watching all matches
+SPECTATOR_MAX_FPS = 10
+# turns per page of a historic match replay, by default and at most
+REPLAY_PAGE_SIZE = 100
+MAX_REPLAY_PAGE_SIZE = 1000
+# matches per page of a historic match query, by default and at most
+QUERY_PAGE_SIZE = 50
+MAX_QUERY_PAGE_SIZE = 1000
+# upper bounds of the timing histogram buckets in seconds, 1µs up to ~16s
+METRICS_BUCKETS = [1e-6 * 2**i for i in range(25)]
+# seconds between updates of the per second rates
+METRICS_RATE_INTERVAL = 10.0
+# codec for the board states in match histories, "none" or "zlib:<level>"
+HISTORY_CODEC = "zlib:6"
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-quantile.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(METRICS_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """
+    Phase timings (histograms), counters and gauges of the server. Disabled
+    by default; then clock() returns None, lap() and count() return at once
+    and nothing is recorded. Timing a phase looks like
+
+        t = metrics.clock()
+        ...
+        t = metrics.lap("phase", t)
+    """
+    def __init__(self):
+        self.enabled = False
+        self.started = None
+        self.histograms = {}
+        self.counters = {}
+        # name -> function returning the current value
+        self.gauges = {}
+        # counter name -> (value at the last tick, increase per second since the tick before)
+        self.rates = {}
+        self.ticker = None
+
+    def enable(self, rate_interval=METRICS_RATE_INTERVAL):
+        self.enabled = True
+        self.started = time.time()
+        self.ticker = task.LoopingCall(self.tick, rate_interval)
+        self.ticker.start(rate_interval, now=False)
+
+    def clock(self):
+        return time.perf_counter() if self.enabled else None
+
+    def lap(self, phase, start):
+        if start is None:
+            return None
+        now = time.perf_counter()
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            histogram = self.histograms[phase] = Histogram()
+        histogram.observe(now - start)
+        return now
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def tick(self, interval):
+        for name, value in self.counters.items():
+            last = self.rates.get(name, (0, 0.0))[0]
+            self.rates[name] = (value, (value - last) / interval)
+
+    def snapshot(self):
+        return {
+            "uptime": time.time() - self.started if self.started else 0.0,
+            "counters": dict(self.counters),
+            "rates": dict((name + "_per_second", rate) for name, (value, rate) in self.rates.items()),
+            "gauges": dict((name, value()) for name, value in self.gauges.items()),
+            "phases": dict((phase, {
+                "count": h.count,
+                "mean": h.sum / h.count if h.count else 0.0,
+                "p50": h.quantile(0.5),
+                "p95": h.quantile(0.95),
+                "p99": h.quantile(0.99)
+            }) for phase, h in self.histograms.items())
+        }
+
+    def render(self):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append("# TYPE blobs_{}_total counter".format(name))
+            lines.append("blobs_{}_total {}".format(name, value))
+        for name, value in sorted(self.gauges.items()):
+            lines.append("# TYPE blobs_{} gauge".format(name))
+            lines.append("blobs_{} {}".format(name, value()))
+        lines.append("# TYPE blobs_phase_seconds histogram")
+        for phase, h in sorted(self.histograms.items()):
+            seen = 0
+            for bound, count in zip(METRICS_BUCKETS + ["+Inf"], h.counts):
+                seen += count
+                lines.append('blobs_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(phase, bound, seen))
+            lines.append('blobs_phase_seconds_sum{{phase="{}"}} {}'.format(phase, repr(h.sum)))
+            lines.append('blobs_phase_seconds_count{{phase="{}"}} {}'.format(phase, h.count))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class Connection(basic.LineReceiver, abc.ABC):
+    """
+    Request framing shared by bot and spectator connections: newline delimited
+    JSON by default, length-prefixed wire frames after switchToBinary().
+    All requests contained in one read are handled in order. The connection is
+    registered as producer on its transport, so while the outgoing buffer is
+    full no further requests are read or handled. Close it with disconnect().
+    """
+    delimiter = b"\n"
+    MAX_LENGTH = MAX_MESSAGE_SIZE
+
+    # set to a wire.FrameReader once binary framing was negotiated
+    frames = None
+    compress_frames = False
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+
+    def lineReceived(self, line):
+        line = line.strip()
+        if not line:
+            return
+        t = metrics.clock()
+        try:
+            data = json.loads(line.decode("utf8"))
+        except Exception as e:
+            self.requestParseFailed(e)
+            return
+        metrics.lap("parse", t)
+        self.handleRequest(data)
+
+    def rawDataReceived(self, data):
+        self.frames.push(data)
+        self._handleFrames()
+
+    def resumeProducing(self):
+        basic.LineReceiver.resumeProducing(self)
+        if self.frames is not None and not self.paused:
+            self._handleFrames()
+
+    def _handleFrames(self):
+        while self.frames is not None and not self.paused and not self.transport.disconnecting:
+            try:
+                body = self.frames.pop()
+            except wire.FrameError as e:
+                # without a valid length prefix the rest of the stream can't be split up
+                self.frames.buffer = b""
+                self.requestParseFailed(e)
+                self.disconnect()
+                return
+            if body is None:
+                return
+            t = metrics.clock()
+            try:
+                data = wire.decodeFrame(body, MAX_MESSAGE_SIZE)
+            except Exception as e:
+                # the frame was complete, so the ones after it are still fine
+                self.requestParseFailed(e)
+                continue
+            metrics.lap("parse", t)
+            self.handleRequest(data)
+
+    def switchToBinary(self, compress):
+        self.frames = wire.FrameReader(MAX_MESSAGE_SIZE)
+        self.compress_frames = compress
+        self.setRawMode()
+
+    def switchToJson(self):
+        remaining, self.frames = self.frames.buffer, None
+        self.setLineMode(remaining)
+
+    def lineLengthExceeded(self, line):
+        self.requestParseFailed(Exception("request exceeds {} bytes".format(MAX_MESSAGE_SIZE)))
+        self.disconnect()
+
+    def disconnect(self):
+        """
+        Closes the connection once everything written so far was sent. The
+        transport only closes a connection without a producer: with one that
+        is paused, it would resume the producer instead of closing.
+        """
+        if self.transport.disconnecting:
+            return
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
+
+    @abc.abstractmethod
+    def requestParseFailed(self, error):
+        """
+        Called with the error for every request that could not be decoded.
+        """
+
+    @abc.abstractmethod
+    def handleRequest(self, data):
+        """
+        Called with every decoded request, in order of arrival.
+        """
+
+    def setProtocol(self, data):
+        """
+        Handles a set_protocol request.
+        """
+        if data.get("protocol") == "binary":
+            # the response still goes out in the old framing, everything after it is framed
+            self._sendSuccessResponse()
+            if self.frames is None:
+                self.switchToBinary(bool(data.get("compress", False)))
+        elif data.get("protocol") == "json":
+            self._sendSuccessResponse()
+            if self.frames is not None:
+                self.switchToJson()
+        else:
+            self._sendErrorResponse("Unknown protocol.")
+
+    def _sendMessage(self, data, arrays=None):
+        if self.frames is not None:
+            self._write(wire.encodeFrame(data, arrays, self.compress_frames))
+        else:
+            self._write(json.dumps(data).encode("utf8")+b"\n")
 
-class User(protocol.Protocol):
+    def _write(self, data):
+        metrics.count("bytes_sent", len(data))
+        self.transport.write(data)
+
+    def _sendErrorResponse(self, message, **kwargs):
+        pkg = {
+            "type": "response",
+            "status": "failure",
+            "message": message
+        }
+        pkg.update(kwargs)
+        self._sendMessage(pkg)
+
+    def _sendSuccessResponse(self, message="Ok.", **kwargs):
+        pkg = {
+            "type": "response",
+            "status": "success",
+            "message": message
+        }
+        pkg.update(kwargs)
+        self._sendMessage(pkg)
+
+
+class User(Connection):
     """
     A dictionary of all valid network states with accepted requests.
     Used for automated package validity checks.
     """
     network_states = {
         # freshly connected user. No successful registration or login, yet.
-        "unauthorized": ["register", "login"],
+        "unauthorized": ["register", "login", "set_protocol"],
         # user is in lobby and awaits connection
-        "lobby": [],
-        "game_waiting": [],
-        "game_your_turn": ["move"],
+        "lobby": ["set_protocol"],
+        "game_waiting": ["resync"],
+        "game_your_turn": ["move", "resync"],
     }
     """
     Required fields in the JSON dictionary forming each request.
@@ -39,7 +360,9 @@ class User(protocol.Protocol):
     request_fields = {
         "register": ["user", "password"],
         "login": ["user", "password"],
-        "move": ["from", "to"]
+        "move": ["from", "to"],
+        "resync": [],
+        "set_protocol": ["protocol"]
     }
     def __init__(self, connection_id, addr, lobby):
         self.logger = logging.getLogger("User(id={})".format(connection_id))
@@ -50,6 +373,14 @@ class User(protocol.Protocol):
         self.currentMatch = None
         self.username = None
         self.consecutive_failed_turns = 0
+        # opt-in at login: only send fields changed since the user's previous turn
+        self.delta_updates = False
+        # opt-in at login: go back into the matchmaking queue after a match instead of disconnecting
+        self.requeue = False
+        # board size of the matches the user is paired for, chosen at login
+        self.board_size = None
+        self.board_revision = None
+        self.turn_seq = 0
 
     def __str__(self):
         return "User(id={}, name={})".format(self.connection_id, self.username)
@@ -63,38 +394,78 @@ class User(protocol.Protocol):
         assert isinstance(match, Match)
         self.network_state = "game_waiting"
         self.currentMatch = match
+        # a requeued user starts over, failed turns of the last match don't count
+        self.consecutive_failed_turns = 0
+        self.board_revision = None
+        self.turn_seq = 0
+
+    def matchFinished(self, winner):
+        self.currentMatch = None
+        if not self.requeue:
+            self.disconnect()
+            return
+        self.network_state = "lobby"
+        self._sendMessage({
+            "type": "match_finished",
+            "winner": winner
+        })
+        self.lobby.matchmaker.enqueue(self)
+
+    def turnTimedOut(self):
+        # a move arriving after this is rejected
+        self.network_state = "game_waiting"
 
     def askTurn(self):
         names = self.currentMatch.playerNames()
-        populated = self.currentMatch.board.populated()
-        owners = self.currentMatch.board.owner[populated]
-        values = self.currentMatch.board.values[populated]
-        used = [(int(x), int(y)) for x, y in zip(populated[0], populated[1])]
+        board = self.currentMatch.board
+        full = not self.delta_updates or self.board_revision is None
+        if full:
+            fields = board.populated()
+        else:
+            changed = board.changesSince(self.board_revision)
+            if changed is None:
+                full, fields = True, board.populated()
+            else:
+                fields = tuple(np.array(changed, dtype=np.intp).reshape((-1, 2)).T)
+        self.board_revision = board.revision()
+        owners = board.ownerIds(board.owner[fields])
+        values = board.values[fields]
         self.network_state = "game_your_turn"
+        self.turn_seq += 1
         pkg = {
             "type": "your_turn",
             "player_names": names,
-            "board_size": self.currentMatch.board.size,
-            "fields_used": used,
-            "fields_owned_by": [int(x) for x in owners],
-            "fields_values": [int(x) for x in values]
+            "board_size": board.size,
         }
-        self.transport.write(json.dumps(pkg).encode("utf8")+b"\n")
+        if self.delta_updates:
+            # with deltas, fields_* only list what changed; cleared fields have owner 0
+            pkg["seq"] = self.turn_seq
+            pkg["full"] = full
+        if self.frames is not None:
+            self._sendMessage(pkg, {
+                "fields_used": np.stack(fields, axis=1).astype(np.uint16),
+                "fields_owned_by": owners,
+                "fields_values": values
+            })
+            return
+        pkg["fields_used"] = [(int(x), int(y)) for x, y in zip(fields[0], fields[1])]
+        pkg["fields_owned_by"] = [int(x) for x in owners]
+        pkg["fields_values"] = [int(x) for x in values]
+        self._sendMessage(pkg)
+
+    def requestParseFailed(self, e):
+        self.logger.error("Invalid JSON string received from connection ID {} via {}\n{}".format(
+            self.connection_id, self.address, str(e))
+        )
+        self._sendErrorResponse("Invalid request, JSON/UTF8 error: {}".format(str(e)))
+        self.disconnect()
 
-    def dataReceived(self, rawdata):
+    def handleRequest(self, data):
         # internal check. Have we set the network state to a valid value?
         if self.network_state not in User.network_states.keys():
             raise Exception("Somewhere an invalid network state was set for connection ID {}".format(self.connection_id))
-        try:
-            rawdata = rawdata.decode("utf8")
-            data = json.loads(rawdata)
-        except Exception as e:
-            self.logger.error("Invalid JSON string received from connection ID {} via {}\n{}".format(
-                self.connection_id, self.address, str(e))
-            )
-            self._sendErrorResponse("Invalid request, JSON/UTF8 error: {}".format(str(e)))
-            self.transport.loseConnection()
-            #self.transport.close()
+        if not isinstance(data, dict) or "type" not in data:
+            self._sendErrorResponse("Required field 'type' not found.")
             return
         # Is the request type known to the server, at all?
         if data["type"] not in User.request_fields.keys():
@@ -108,6 +479,7 @@ class User(protocol.Protocol):
         for field in User.request_fields[data["type"]]:
             if field not in data:
                 self._sendErrorResponse("Required field '{}' not found.".format(field))
+                return
         # Dispatch user request to different subsytems
         if data["type"] == "register":
             if self.lobby.registerUser(data["user"], data["password"]):
@@ -115,65 +487,373 @@ class User(protocol.Protocol):
             else:
                 self._sendErrorResponse("Username already taken.")
         elif data["type"] == "login":
+            board_size = data.get("board_size", self.lobby.board_size)
+            if not isinstance(board_size, int) or not MIN_BOARD_SIZE <= board_size <= MAX_BOARD_SIZE:
+                self._sendErrorResponse("board_size must be between {} and {}.".format(MIN_BOARD_SIZE, MAX_BOARD_SIZE))
+                return
             if self.lobby.checkUserLogin(data["user"], data["password"]):
                 self._sendSuccessResponse()
                 self.network_state = "lobby"
                 self.username = data["user"]
+                self.delta_updates = bool(data.get("delta", False))
+                self.requeue = bool(data.get("requeue", False))
+                self.board_size = board_size
                 self.lobby.notifyUserConnected(self)
             else:
                 self._sendErrorResponse("Invalid login credentials.")
+        elif data["type"] == "set_protocol":
+            self.setProtocol(data)
+        elif data["type"] == "resync":
+            # the next your_turn contains the full board again
+            self.board_revision = None
+            self._sendSuccessResponse()
+            if self.network_state == "game_your_turn":
+                self.askTurn()
         elif data["type"] == "move":
-            ok, message = self.currentMatch.checkedTurn(Turn(data["from"], data["to"], self))
-            if ok:
-                self._sendSuccessResponse(message)
-                self.consecutive_failed_turns = 0
-            else:
-                self._sendErrorResponse(message)
-                self.consecutive_failed_turns += 1
             self.network_state = "game_waiting"
-            done, winner = self.currentMatch.checkMatchFinished()
-            if done:
-                self.currentMatch.finalize()
-            else:
-                next = self.currentMatch.nextUser()
-                next.askTurn()
+            self.currentMatch.submitTurn(Turn(data["from"], data["to"], self))
 
-    def _sendErrorResponse(self, message):
-        pkg = {
-            "type": "response",
-            "status": "failure",
-            "message": message
-        }
-        self.transport.write(json.dumps(pkg).encode("utf8")+b"\n")
+    def turnResult(self, ok, message):
+        if ok:
+            self._sendSuccessResponse(message)
+            self.consecutive_failed_turns = 0
+        else:
+            self._sendErrorResponse(message)
+            self.consecutive_failed_turns += 1
 
-    def _sendSuccessResponse(self, message="Ok."):
-        pkg = {
-            "type": "response",
-            "status": "success",
-            "message": message
-        }
-        self.transport.write(json.dumps(pkg).encode("utf8")+b"\n")
+
+
+class Leaderboard:
+    """
+    Users ordered by rating, best first, in an indexable skip list: adding,
+    removing and moving a user as well as finding a user's rank or the entry
+    at a rank take O(log n); a page of k entries takes O(log n + k).
+    Ranks start at 0, users of equal rating are ordered by name.
+    """
+    MAX_LEVEL = 32
+
+    class Node:
+        __slots__ = ("key", "next", "width")
+
+        def __init__(self, key, level):
+            self.key = key
+            self.next = [None] * level
+            # number of level 0 steps the link on each level skips
+            self.width = [1] * level
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.tail = Leaderboard.Node((float("inf"), ""), 0)
+        self.head = Leaderboard.Node(None, Leaderboard.MAX_LEVEL)
+        self.head.next = [self.tail] * Leaderboard.MAX_LEVEL
+        # levels above this one only link head and tail
+        self.level = 1
+        self.ratings = {}
+
+    def __len__(self):
+        return len(self.ratings)
+
+    def __contains__(self, name):
+        return name in self.ratings
+
+    def _path(self, key):
+        """
+        Returns the last node before key on every level, and the rank of each.
+        """
+        chain = [self.head] * Leaderboard.MAX_LEVEL
+        ranks = [-1] * Leaderboard.MAX_LEVEL
+        node, rank = self.head, -1
+        for level in reversed(range(self.level)):
+            while node.next[level].key < key:
+                rank += node.width[level]
+                node = node.next[level]
+            chain[level], ranks[level] = node, rank
+        return chain, ranks
+
+    def _randomLevel(self):
+        level = 1
+        while level < Leaderboard.MAX_LEVEL and self.random.random() < 0.5:
+            level += 1
+        return level
+
+    def load(self, ratings):
+        """
+        Fills an empty leaderboard from (name, rating) pairs. Building the list
+        from the sorted pairs is much faster than adding them one by one.
+        """
+        last = [self.head] * Leaderboard.MAX_LEVEL
+        last_rank = [-1] * Leaderboard.MAX_LEVEL
+        for rank, key in enumerate(sorted((-rating, name) for name, rating in ratings)):
+            level = self._randomLevel()
+            node = Leaderboard.Node(key, level)
+            for i in range(level):
+                last[i].next[i], last[i].width[i] = node, rank - last_rank[i]
+                last[i], last_rank[i] = node, rank
+            self.level = max(self.level, level)
+            self.ratings[key[1]] = -key[0]
+        for i in range(self.level):
+            last[i].next[i], last[i].width[i] = self.tail, len(self.ratings) - last_rank[i]
+
+    def set(self, name, rating):
+        if name in self.ratings:
+            self.remove(name)
+        key = (-rating, name)
+        chain, ranks = self._path(key)
+        level = self._randomLevel()
+        for i in range(self.level, level):
+            self.head.width[i] = len(self.ratings) + 1
+        self.level = max(self.level, level)
+        node = Leaderboard.Node(key, level)
+        rank = ranks[0] + 1
+        for i in range(level):
+            before = chain[i]
+            node.next[i], before.next[i] = before.next[i], node
+            node.width[i] = ranks[i] + before.width[i] - ranks[0]
+            before.width[i] = rank - ranks[i]
+        for i in range(level, self.level):
+            chain[i].width[i] += 1
+        self.ratings[name] = rating
+
+    def remove(self, name):
+        key = (-self.ratings.pop(name), name)
+        chain, ranks = self._path(key)
+        node = chain[0].next[0]
+        for i in range(self.level):
+            if i < len(node.next):
+                chain[i].width[i] += node.width[i] - 1
+                chain[i].next[i] = node.next[i]
+            else:
+                chain[i].width[i] -= 1
+
+    def rank(self, name):
+        chain, ranks = self._path((-self.ratings[name], name))
+        return ranks[0] + 1
+
+    def page(self, start, count):
+        """
+        Returns up to count (rank, name, rating) entries from rank start on.
+        """
+        node, rank = self.head, -1
+        for level in reversed(range(self.level)):
+            while rank + node.width[level] <= start and node.next[level] is not self.tail:
+                rank += node.width[level]
+                node = node.next[level]
+        entries = []
+        node = node.next[0] if rank < start else node
+        rank = max(rank, start)
+        while node is not self.tail and len(entries) < count:
+            entries.append((rank, node.key[1], -node.key[0]))
+            node, rank = node.next[0], rank + 1
+        return entries
+
+
+class UserStore:
+    """
+    Registered users, kept in an SQLite database. Every change is a single row
+    update; commits are batched and happen at most COMMIT_INTERVAL seconds
+    after a change, and when the reactor shuts down.
+    """
+    def __init__(self, filename="users.sqlite", legacy_filename="user.db"):
+        self.logger = logging.getLogger("UserStore")
+        self.db = sqlite3.connect(filename)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS users ("
+                        "name TEXT PRIMARY KEY, password TEXT NOT NULL, score INTEGER NOT NULL DEFAULT 0, "
+                        "rating REAL NOT NULL DEFAULT {})".format(INITIAL_RATING))
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(users)")]
+        if "rating" not in columns:
+            # stores created before ratings were introduced
+            self.db.execute("ALTER TABLE users ADD COLUMN rating REAL NOT NULL DEFAULT {}".format(INITIAL_RATING))
+            self.db.commit()
+        self.pending_commit = None
+        self.importLegacy(legacy_filename)
+        self.leaderboard = Leaderboard()
+        self.leaderboard.load(self.db.execute("SELECT name, rating FROM users"))
+        reactor.addSystemEventTrigger("before", "shutdown", self.commit)
+
+    def importLegacy(self, filename):
+        """
+        Imports the JSON user.db written by older versions, if the store is empty.
+        """
+        if self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0] > 0:
+            return
+        try:
+            with open(filename) as f:
+                users = json.loads(f.read())
+        except IOError:
+            self.logger.info("No user database found.")
+            return
+        self.db.executemany("INSERT OR IGNORE INTO users (name, password, score) VALUES (?, ?, ?)",
+                            [(name, u["password"], u.get("score", 0)) for name, u in users.items()])
+        self.db.commit()
+        self.logger.info("Imported {} users from {}".format(len(users), filename))
+
+    def __contains__(self, name):
+        return self.db.execute("SELECT 1 FROM users WHERE name = ?", (name,)).fetchone() is not None
+
+    def register(self, name, password):
+        cursor = self.db.execute("INSERT OR IGNORE INTO users (name, password) VALUES (?, ?)", (name, password))
+        self.scheduleCommit()
+        if cursor.rowcount != 1:
+            return False
+        self.leaderboard.set(name, INITIAL_RATING)
+        return True
+
+    def score(self, name):
+        row = self.db.execute("SELECT score FROM users WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def checkLogin(self, name, password):
+        row = self.db.execute("SELECT password FROM users WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == password
+
+    def addScore(self, name, amount=1):
+        self.db.execute("UPDATE users SET score = score + ? WHERE name = ?", (amount, name))
+        self.scheduleCommit()
+
+    def rating(self, name):
+        return self.leaderboard.ratings.get(name, INITIAL_RATING)
+
+    def addResult(self, names, winner):
+        """
+        Updates the Elo ratings of the users of a finished match. Every pair of
+        users counts as one game: won by the winner, else a draw.
+        """
+        names = [name for name in set(names) if name in self.leaderboard]
+        changes = dict((name, 0.0) for name in names)
+        for a, b in itertools.combinations(names, 2):
+            expected = 1.0 / (1.0 + 10 ** ((self.rating(b) - self.rating(a)) / 400.0))
+            result = 1.0 if winner == a else 0.0 if winner == b else 0.5
+            changes[a] += ELO_K * (result - expected)
+            changes[b] -= ELO_K * (result - expected)
+        for name, change in changes.items():
+            rating = self.rating(name) + change
+            self.db.execute("UPDATE users SET rating = ? WHERE name = ?", (rating, name))
+            self.leaderboard.set(name, rating)
+        self.scheduleCommit()
+
+    def publicRecords(self):
+        """
+        Returns name -> record for all users, without passwords.
+        """
+        return dict((name, {"score": score, "rating": rating})
+                    for name, score, rating in self.db.execute("SELECT name, score, rating FROM users"))
+
+    def scheduleCommit(self):
+        if self.pending_commit is None:
+            self.pending_commit = reactor.callLater(COMMIT_INTERVAL, self.commit)
+
+    def commit(self):
+        if self.pending_commit is not None and self.pending_commit.active():
+            self.pending_commit.cancel()
+        self.pending_commit = None
+        t = metrics.clock()
+        self.db.commit()
+        metrics.lap("user_commit", t)
+
+
+class Matchmaker:
+    """
+    Queue of users waiting for a match. Enqueueing and dequeueing are O(1):
+    users leaving the queue are only forgotten in `waiting`, their stale queue
+    entries are skipped when they come up. Users are only paired with others
+    who asked for the same board size and, with a band width set, whose score
+    falls into the same band.
+    """
+    def __init__(self, lobby, band=MATCHMAKING_BAND):
+        self.logger = logging.getLogger("Matchmaker")
+        self.lobby = lobby
+        self.band = band
+        # (band, board size) -> deque of (ticket, user)
+        self.queues = {}
+        # user -> ticket of their current queue entry
+        self.waiting = {}
+        self.next_ticket = 0
+
+    def bandOf(self, user):
+        if not self.band:
+            return 0
+        return self.lobby.user_db.score(user.username) // self.band
+
+    def queueOf(self, user):
+        return self.bandOf(user), user.board_size
+
+    def enqueue(self, user):
+        self.next_ticket += 1
+        self.waiting[user] = self.next_ticket
+        key = self.queueOf(user)
+        self.queues.setdefault(key, deque()).append((self.next_ticket, user))
+        self.pump(key)
+
+    def remove(self, user):
+        self.waiting.pop(user, None)
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def pump(self, key):
+        """
+        Starts as many matches as can be formed from one queue.
+        """
+        queue = self.queues[key]
+        group = []
+        while queue:
+            ticket, user = queue.popleft()
+            if self.waiting.get(user) != ticket:
+                continue
+            group.append((ticket, user))
+            if len(group) == PLAYERS_IN_MATCH:
+                users = [u for _, u in group]
+                for u in users:
+                    del self.waiting[u]
+                group = []
+                self.lobby.makeMatch(users)
+        queue.extendleft(reversed(group))
+        if not queue:
+            del self.queues[key]
 
 
 class Lobby(protocol.Factory):
-    def __init__(self):
+    def __init__(self, workers=None, board_size=BOARD_SIZE, turn_timeout=TURN_TIMEOUT, time_budget=MATCH_TIME_BUDGET):
         self.logger = logging.getLogger("Lobby")
-        self.user_db = {}
+        self.user_db = UserStore()
         self.current_user_id = MIN_PID # lower IDs have special meanings ("no owner" etc)
-        self.loadUserDb()
-        self.activeUsers = []
+        self.activeUsers = set()
+        self.matchmaker = Matchmaker(self)
         self.activeMatches = []
-        self.history = MatchHistory()
+        self.next_match_id = 0
+        # a WorkerPool when matches run in separate processes
+        self.workers = workers
+        # board size for users who don't ask for one at login
+        self.board_size = board_size
+        self.turn_timeout = turn_timeout
+        self.time_budget = time_budget
+        self.history = MatchHistory(background=True)
         self.waiting_spectators = []
+        self.all_spectators = []
+        metrics.gauge("active_matches", lambda: len(self.activeMatches))
+        metrics.gauge("connected_users", lambda: len(self.activeUsers))
+        metrics.gauge("queued_users", lambda: len(self.matchmaker))
 
     def addSpectator(self, spectator):
         self.logger.debug("addSpectator, active matches: {}".format(repr(self.activeMatches)))
         if self.activeMatches:
-            self.activeMatches[0].spectators.append(spectator)
             spectator.startSpectating(self.activeMatches[0])
         else:
             self.waiting_spectators.append(spectator)
 
+    def watchAll(self, spectator):
+        self.all_spectators.append(spectator)
+        for match in self.activeMatches:
+            spectator.startSpectating(match)
+
+    def findMatch(self, match_id):
+        for match in self.activeMatches:
+            if match.match_id == match_id:
+                return match
+        return None
+
     def removeSpectator(self, spectator):
         spectator.stopSpectating()
         try:
@@ -183,55 +863,36 @@ class Lobby(protocol.Factory):
 
     def notifyUserConnected(self, user):
         self.logger.info("User connected to lobby: {}".format(user))
-        self.activeUsers.append(user)
+        self.activeUsers.add(user)
         self.logger.debug("Users active: {}".format(len(self.activeUsers)))
-        idle = [u for u in self.activeUsers if u.network_state == "lobby"]
-        self.logger.debug("Users idle: {}".format(len(idle)))
-        if len(idle) >= PLAYERS_IN_MATCH:
-            self.makeMatch(idle[:PLAYERS_IN_MATCH])
+        self.matchmaker.enqueue(user)
+        self.logger.debug("Users idle: {}".format(len(self.matchmaker)))
 
     def notifyUserDisconnected(self, user):
         self.logger.info("User disconnected from lobby: {}".format(user))
-        if user.network_state != "unauthorized":
-            self.activeUsers.remove(user)
+        self.activeUsers.discard(user)
+        self.matchmaker.remove(user)
 
     def makeMatch(self, users):
         self.logger.info("Starting new match.")
-        board = Board(BOARD_SIZE)
-        board.populate(users)
-        match = Match(users, board, self)
+        self.next_match_id += 1
+        size = users[0].board_size
+        if self.workers:
+            match = RemoteMatch(users, size, self, self.next_match_id, self.workers.assign())
+        else:
+            board = Board(size)
+            board.populate(users)
+            match = Match(users, board, self, self.next_match_id)
         self.activeMatches.append(match)
         for user in users:
             user.matchStarted(match)
-        users[0].askTurn()
-        for spec in self.waiting_spectators:
-            spec.startSpectating(match)
+        match.start()
 
     def registerUser(self, user, password):
-        if user in self.user_db:
-            return False
-        self.user_db[user] = {
-            "password": password,
-            "score": 0,
-        }
-        self.writeUserDb()
-        return True
+        return self.user_db.register(user, password)
 
     def checkUserLogin(self, user, password):
-        if user not in self.user_db:
-            return False
-        return self.user_db[user]["password"] == password
-
-    def writeUserDb(self):
-        with open("user.db", "w") as f:
-            f.write(json.dumps(self.user_db, indent=2))
-
-    def loadUserDb(self):
-        try:
-            with open("user.db") as f:
-                self.user_db = json.loads(f.read())
-        except IOError:
-            self.logger.info("No user database found.")
+        return self.user_db.checkLogin(user, password)
 
     def buildProtocol(self, addr):
         self.current_user_id += 1
@@ -245,58 +906,240 @@ class Turn:
         self.player = player
 
 
+class Player:
+    """
+    Stand-in for a User where there is no connection, e.g. inside a match
+    worker process. Asking it for a turn does nothing.
+    """
+    def __init__(self, connection_id, username):
+        self.connection_id = connection_id
+        self.username = username
+        self.consecutive_failed_turns = 0
+
+    def askTurn(self):
+        pass
+
+
 class Match:
-    def __init__(self, users, board, lobby=None):
+    def __init__(self, users, board, lobby=None, match_id=None):
         self.logger = logging.getLogger("Match({})".format(
             ", ".join("{}({})".format(u.username, u.connection_id) for u in users)))
         assert isinstance(board, Board)
         self.lobby = lobby
+        self.match_id = match_id
         self.board = board
+        for user in users:
+            board.addPlayer(user.connection_id)
         self.users = users
         self.currentUser = self.users[0]
         self.current_round = 0
         self.history = {
             "users": [u.username for u in self.users],
             "board_size": self.board.size,
+            "format": 2,
+            "codec": MatchHistory.codec.name,
+            "keyframe_interval": KEYFRAME_INTERVAL,
             "turns": [],
             "status": "playing",
             "winner": None
         }
+        self.history_revision = 0
+        # fields written to deltas since the last snapshot, see addStateToHistory()
+        self.changes_since_snapshot = 0
         self.spectators = []
+        self.initTiming()
         self.addStateToHistory()
 
-    def finalize(self):
-        self.logger.info("Finalize")
-        for user in self.users:
-            user.transport.loseConnection()
-        specs = self.spectators[:]
+    def initTiming(self):
+        """
+        Deadlines and response times. Only used by the lobby, which asks the users.
+        """
+        self.deadline = None
+        self.asked_at = None
+        self.latencies = dict((u, []) for u in self.users)
+        self.timeouts = dict((u, 0) for u in self.users)
+        self.consecutive_timeouts = dict((u, 0) for u in self.users)
+        budget = self.lobby.time_budget if self.lobby else None
+        # user -> seconds left on the chess clock
+        self.clocks = dict((u, budget) for u in self.users) if budget else None
+        # users who lost by running out of time
+        self.forfeited = set()
+
+    def askCurrentUser(self):
+        """
+        Asks the current user for a turn and starts the deadline for the answer,
+        which is the turn timeout or what is left on the user's clock.
+        """
+        user = self.currentUser
+        self.cancelDeadline()
+        limits = []
+        if self.lobby and self.lobby.turn_timeout:
+            limits.append(self.lobby.turn_timeout)
+        if self.clocks is not None:
+            limits.append(max(self.clocks[user], 0))
+        self.asked_at = reactor.seconds()
+        if limits:
+            self.deadline = reactor.callLater(min(limits), self.turnTimedOut, user)
+        user.askTurn()
+        self.trimChanges()
+
+    def trimChanges(self, *revisions):
+        """
+        Drops the part of the board's change log which the history and all
+        users have seen. revisions are the positions of further readers.
+        """
+        readers = [self.history_revision] + [getattr(u, "board_revision", None) for u in self.users]
+        readers = [r for r in readers + list(revisions) if r is not None]
+        self.board.trimChanges(min(readers) if readers else self.board.revision())
+
+    def cancelDeadline(self):
+        if self.deadline is not None and self.deadline.active():
+            self.deadline.cancel()
+        self.deadline = None
+
+    def _timeSpent(self, user):
+        spent = reactor.seconds() - self.asked_at
+        self.latencies[user].append(spent)
+        if self.clocks is not None:
+            self.clocks[user] -= spent
+        return spent
+
+    def turnReceived(self, user):
+        """
+        Stops the deadline when the asked user answers.
+        """
+        self.cancelDeadline()
+        if self.asked_at is not None and user in self.latencies:
+            self._timeSpent(user)
+            self.consecutive_timeouts[user] = 0
+        self.asked_at = None
+
+    def turnTimedOut(self, user):
+        self.deadline = None
+        self._timeSpent(user)
+        self.asked_at = None
+        self.timeouts[user] += 1
+        self.consecutive_timeouts[user] += 1
+        metrics.count("turn_timeouts")
+        self.logger.info("{} timed out".format(user))
+        if self.consecutive_timeouts[user] >= MAX_CONSECUTIVE_TIMEOUTS or (
+                self.clocks is not None and self.clocks[user] <= 0):
+            self.forfeited.add(user)
+        user.turnTimedOut()
+        self.skipTurn(user)
+
+    def skipTurn(self, user):
+        self.skippedTurn()
+        self.turnDone(user, False, "turn timed out")
+
+    def latencyStats(self):
+        """
+        Response times per user in seconds, for the match history.
+        """
+        stats = {}
+        for user, latencies in self.latencies.items():
+            latencies = np.array(latencies)
+            entry = {"turns": len(latencies), "timeouts": self.timeouts[user]}
+            if len(latencies):
+                entry.update({
+                    "mean": round(float(latencies.mean()), 4),
+                    "median": round(float(np.median(latencies)), 4),
+                    "p95": round(float(np.percentile(latencies, 95)), 4),
+                    "max": round(float(latencies.max()), 4)
+                })
+            if self.clocks is not None:
+                entry["clock"] = round(max(self.clocks[user], 0), 4)
+            stats[user.username] = entry
+        return stats
+
+    def start(self):
+        self.askCurrentUser()
+        for spec in self.lobby.waiting_spectators[:] + self.lobby.all_spectators:
+            spec.startSpectating(self)
+
+    def submitTurn(self, turn):
+        self.turnReceived(turn.player)
+        ok, message = self.checkedTurn(turn)
+        self.turnDone(turn.player, ok, message)
+
+    def turnDone(self, user, ok, message):
+        metrics.count("turns")
+        user.turnResult(ok, message)
+        done, winner = self.checkMatchFinished()
+        if done:
+            self.finalize()
+        else:
+            self.nextUser()
+            self.askCurrentUser()
+
+    def settle(self):
+        """
+        Decides the winner and completes the match history.
+        """
         try:
             done, winner = self.checkMatchFinished()
             self.history["status"] = "finished"
             if not winner:
-                sizes = self.getPlayerSizes()
-                winner, max_score = max(sizes.items(),
-                    key=lambda x: x[1] if x[0].consecutive_failed_turns < MAX_CONSECUTIVE_FAILS else -1)
-                if list(sizes.values()).count(max_score) > 1:
-                    winner = None
+                # users who failed or timed out too often can't win
+                sizes = dict((user, size) for user, size in self.getPlayerSizes().items()
+                             if user.consecutive_failed_turns < MAX_CONSECUTIVE_FAILS and user not in self.forfeited)
+                if sizes:
+                    winner, max_score = max(sizes.items(), key=lambda x: x[1])
+                    if list(sizes.values()).count(max_score) > 1:
+                        winner = None
             if winner:
                 self.history["winner"] = winner.username
-            self.logger.info("Match won by: {}".format(winner))
-            if self.history["winner"]:
-                self.lobby.user_db[self.history["winner"]]["score"] += 1
-                self.lobby.writeUserDb()
             self.addStateToHistory()
-            for spectator in self.spectators:
-                spectator.sendActiveMatch(self)
         except Exception as e:
             self.logger.exception("Error while detecting game winner…")
+
+    def finalize(self):
+        self.logger.info("Finalize")
+        self.settle()
+        self.conclude()
+
+    def conclude(self):
+        """
+        Lobby side of ending a match: scores, storage, spectators and players.
+        """
+        # spectators following whatever is running move on to the next match
+        specs = [spec for spec in self.spectators if spec.mode == "follow"]
+        self.cancelDeadline()
+        try:
+            self.history["latency"] = self.latencyStats()
+            self.history["finished_at"] = time.time()
+            self.logger.info("Match won by: {}".format(self.history["winner"]))
+            if self.history["winner"]:
+                self.lobby.user_db.addScore(self.history["winner"])
+            if self.history["status"] == "finished":
+                self.lobby.user_db.addResult(self.history["users"], self.history["winner"])
+            self.broadcast()
+        except Exception as e:
+            self.logger.exception("Error while concluding match…")
         finally:
-            for spec in self.spectators:
-                spec.streamFinished()
-            self.lobby.history.addMatch(self.history)
+            for spec in self.spectators[:]:
+                spec.streamFinished(self)
+            # an aborted match has no history worth keeping
+            if self.history["status"] != "aborted":
+                self.lobby.history.addMatch(self.history)
+            metrics.count("matches_finished")
             self.lobby.activeMatches.remove(self)
             for spec in specs:
                 self.lobby.addSpectator(spec)
+            for user in self.users:
+                user.matchFinished(self.history["winner"])
+
+    def broadcast(self):
+        """
+        Streams the current state to all spectators. The frame is serialized
+        once per framing in use and the same bytes go to every spectator.
+        """
+        frames = {}
+        for spectator in self.spectators:
+            framing = spectator.framing()
+            if framing not in frames:
+                frames[framing] = Spectator.encodeStreamTurn(self, *framing)
+            spectator.sendFrame(self, frames[framing])
 
     def getCurrentScore(self):
         return dict((user.username, score) for user, score in self.getPlayerSizes().items())
@@ -316,110 +1159,125 @@ class Match:
         return [(u.username, u.connection_id) for u in self.users]
 
     def splitCreatedByTurn(self, affectedPos, destOwner):
-        neighbors = self.board.adjacent(affectedPos)
-        full = self.board.ownedByPlayer(destOwner)
-        components = []
-        for neighbor in neighbors:
-            if self.board.owner[neighbor] != destOwner:
-                continue
-            c = self.board.connected(neighbor)
-            if (c == full).all():
-                break
-            components.append(c)
+        components = self.board.componentsOf(destOwner)
+        if len(components) < 2:
+            return []
         return components
 
     def execFight(self, turn, srcOwner, destOwner):
-        self.board.owner[turn.dest] = srcOwner
         destValue = self.board.values[turn.dest]
         srcValue = self.board.values[turn.source]
         assert srcValue > destValue, "Invalid game move!! Attack with weak field."
-        self.board.values[turn.dest] = srcValue - destValue - 1
+        self.board.setField(turn.dest, srcOwner, srcValue - destValue - 1)
 
         components = self.splitCreatedByTurn(turn.dest, destOwner)
         if len(components) > 0:
-            sizes = [len(q) for q in components]
-            largest = components[np.argmax(sizes)]
+            largest = max(components, key=self.board.componentSize)
+            gained = 0
             for comp in components:
-                if (comp == largest).all():
+                if comp == largest:
                     continue
-                self.board.values[turn.dest] += np.sum(self.board.values[comp])
-                self.board.values[comp] = 0
-                self.board.owner[comp] = NO_OWNER
+                gained += self.board.removeComponent(comp)
+            self.board.setField(turn.dest, srcOwner, self.board.values[turn.dest] + gained)
 
     def execTurn(self, turn: Turn):
         self.logger.debug("Executing turn {}".format(self.current_round))
         destOwner = self.board.owner[turn.dest]
         srcOwner = self.board.owner[turn.source]
         if destOwner == NO_OWNER or srcOwner == destOwner:
-            self.board.values[turn.dest] += 1
-            self.board.owner[turn.dest] = srcOwner
-            self.board.values[turn.source] -= 1
-            if self.board.values[turn.source] == 0:
-                self.board.owner[turn.source] = NO_OWNER
+            self.board.setField(turn.dest, srcOwner, self.board.values[turn.dest] + 1)
+            remaining = self.board.values[turn.source] - 1
+            self.board.setField(turn.source, srcOwner if remaining > 0 else NO_OWNER, remaining)
         elif destOwner == FOOD_OWNER:
-            self.board.owner[turn.dest] = srcOwner
+            self.board.setField(turn.dest, srcOwner, self.board.values[turn.dest])
         else:
             # field owned by enemy
             self.execFight(turn, srcOwner, destOwner)
         assert self.board.playerContiguous(srcOwner)
-        if destOwner >= MIN_PID:
+        if destOwner >= FIRST_PLAYER_SLOT:
             assert self.board.playerContiguous(destOwner)
 
     def paintTurn(self, out):
-        plt.imshow(self.board.owner.astype(np.float64), clim=(1000, 1005), interpolation="nearest", cmap="hot")
+        plt.imshow(self.board.ownerIds(self.board.owner).astype(np.float64), clim=(1000, 1005), interpolation="nearest", cmap="hot")
         plt.savefig(out)
         plt.clf()
 
     def checkTurn(self, turn: Turn):
-        if self.board.owner[turn.source] != turn.player.connection_id:
+        # Board.legalMoves() applies the same rules to all moves at once
+        if not self.board.inside(turn.source):
+            return False, "source location out of bounds"
+
+        slot = self.board.slotOf(turn.player.connection_id)
+        if self.board.owner[turn.source] != slot:
             return False, "source field not populated by you"
 
-        if (0 > turn.dest[0] >= self.board.size) or (0 > turn.dest[1] >= self.board.size):
+        if self.board.values[turn.source] == 0:
+            return False, "source field has no strength left"
+
+        if not self.board.inside(turn.dest):
             return False, "destination location out of bounds"
 
-        if self.board.owner[turn.dest] != turn.player.connection_id:
-            adj = self.board.adjacent(turn.dest)
+        if self.board.owner[turn.dest] != slot:
+            adj = self.board.neighbors(turn.dest)
             for a in adj:
                 if a == turn.source and self.board.values[turn.source] == 1:
                     continue
-                if self.board.owner[a] == turn.player.connection_id:
+                if self.board.owner[a] == slot:
                     break
             else:
                 return False, "no adjacent allied fields at target location"
 
         destOwner = self.board.owner[turn.dest]
-        isEnemy = destOwner > MIN_PID and destOwner != turn.player.connection_id
+        isEnemy = destOwner >= FIRST_PLAYER_SLOT and destOwner != slot
         if isEnemy and self.board.values[turn.dest] + 1 > self.board.values[turn.source]:
             return False, "you cannot attack fields stronger than you"
 
-        if self.board.values[turn.source] == 1:
-            self.board.owner[turn.source] = NO_OWNER
-        if not self.board.playerContiguous(turn.player.connection_id):
-            self.board.owner[turn.source] = turn.player.connection_id
+        if self.board.values[turn.source] == 1 and self.board.isArticulation(turn.source):
             return False, "you would split yourself"
-        self.board.owner[turn.source] = turn.player.connection_id
 
         return True, "turn ok"
 
+    def legalMoves(self, user):
+        """
+        All (sources, destinations) the user could submit, see Board.legalMoves().
+        """
+        return self.board.legalMoves(self.board.slotOf(user.connection_id))
+
+    def skippedTurn(self):
+        """
+        Counterpart of checkedTurn() for a turn that was never submitted.
+        """
+        self.current_round += 1
+        t = metrics.clock()
+        self.addStateToHistory()
+        t = metrics.lap("add_history", t)
+        self.broadcast()
+        metrics.lap("broadcast", t)
+
     def checkedTurn(self, turn):
+        t = metrics.clock()
         ok, message = self.checkTurn(turn)
+        t = metrics.lap("check_turn", t)
         self.current_round += 1
         if ok:
             self.execTurn(turn)
+            t = metrics.lap("exec_turn", t)
         self.addStateToHistory()
-        for spectator in self.spectators:
-            spectator.sendActiveMatch(self)
+        t = metrics.lap("add_history", t)
+        self.broadcast()
+        metrics.lap("broadcast", t)
         return ok, message
 
     def checkMatchFinished(self):
         if self.current_round >= MAX_ROUNDS:
             return True, None
         for u in self.users:
-            if u.consecutive_failed_turns >= MAX_CONSECUTIVE_FAILS:
+            if u.consecutive_failed_turns >= MAX_CONSECUTIVE_FAILS or u in self.forfeited:
                 return True, None
-        owned_by_player = self.board.owner >= MIN_PID
-        interesting = self.board.owner[owned_by_player]
-        return not interesting.any() or (interesting[0] == interesting).all(), self.getUserById(interesting[0])
+        players = self.board.players()
+        if len(players) > 1:
+            return False, None
+        return True, self.getUserById(self.board.playerId(players[0])) if players else None
 
     def getLargestPlayer(self):
         sizes = self.getPlayerSizes()
@@ -432,53 +1290,872 @@ class Match:
     def getPlayerSizes(self):
         sizes = {}
         for user in self.users:
-            size = int(np.sum(self.board.values[self.board.owner == user.connection_id]))
-            sizes[user] = size
+            sizes[user] = self.board.playerValue(self.board.slotOf(user.connection_id))
         return sizes
 
     def addStateToHistory(self):
-        self.history["turns"].append(MatchHistory.encodeState(self.board.values, self.board.owner))
+        turns = self.history["turns"]
+        changed = self.board.changesSince(self.history_revision)
+        self.changes_since_snapshot += len(changed)
+        if self.board.sparse:
+            # Snapshots of large boards cost as much as the populated fields, so one
+            # is only taken once the deltas since the last one add up to as much.
+            # Seeking then never decodes more than twice the size of a snapshot.
+            snapshot = not turns or self.changes_since_snapshot >= self.board.populatedCount()
+        else:
+            snapshot = len(turns) % KEYFRAME_INTERVAL == 0
+        if snapshot and self.board.sparse:
+            # only the populated fields, stored like a delta from an empty board
+            populated = np.stack(self.board.populated(), axis=1)
+            entry = "S" + MatchHistory.encodeDelta(self.board.values, self.board.owner, populated,
+                                                   self.board.slot_ids, MatchHistory.codec)
+        elif snapshot:
+            entry = "K" + MatchHistory.encodeState(self.board.values, self.board.owner,
+                                                   self.board.slot_ids, MatchHistory.codec)
+        else:
+            entry = "D" + MatchHistory.encodeDelta(self.board.values, self.board.owner, changed,
+                                                   self.board.slot_ids, MatchHistory.codec)
+        if snapshot:
+            self.changes_since_snapshot = 0
+        turns.append(entry)
+        self.history_revision = self.board.revision()
 
     def removeUser(self, user):
         if self.currentUser == user:
-            next = self.nextUser()
-            next.askTurn()
+            self.nextUser()
+            self.askCurrentUser()
         self.users.remove(user)
-        mask = self.board.owner == user.connection_id
-        self.board.values[mask] = 0
-        self.board.owner[mask] = NO_OWNER
+        for component in self.board.componentsOf(self.board.slotOf(user.connection_id)):
+            self.board.removeComponent(component)
 
 
-class Board:
+class RemoteMatch(Match):
+    """
+    A match whose board and rules run in a worker process. The reactor process
+    keeps a mirror of the board, updated with the changed fields after every
+    turn, for asking players and feeding spectators.
+    """
+    def __init__(self, users, board_size, lobby, match_id, worker):
+        self.logger = logging.getLogger("RemoteMatch({})".format(
+            ", ".join("{}({})".format(u.username, u.connection_id) for u in users)))
+        self.lobby = lobby
+        self.match_id = match_id
+        self.worker = worker
+        self.board = Board(board_size)
+        # same slots as the worker's board, which populate() assigns in this order
+        for user in users:
+            self.board.addPlayer(user.connection_id)
+        self.users = users
+        self.currentUser = self.users[0]
+        self.current_round = 0
+        # the change log of the mirror board is only read by the users
+        self.history_revision = None
+        # the full history is recorded by the worker and fetched when the match ends
+        self.history = {
+            "users": [u.username for u in self.users],
+            "board_size": board_size,
+            "turns": [],
+            "status": "playing",
+            "winner": None
+        }
+        self.spectators = []
+        self.scores = {}
+        self.done, self.winner_id = False, None
+        self.concluded = False
+        self.initTiming()
+
+    def _call(self, *request):
+        t = metrics.clock()
+        d = self.worker.call(*request)
+        if t is not None:
+            # the phases of a turn run in the worker, this times the whole round trip
+            d.addCallback(self._timed, t)
+        d.addErrback(self._failed)
+        return d
+
+    def _timed(self, reply, start):
+        metrics.lap("worker_call", start)
+        return reply
+
+    def _failed(self, failure):
+        self.logger.error("Worker failed: {}".format(failure.getErrorMessage()))
+        if not self.concluded:
+            # the turns were recorded by the worker and are lost with it
+            self.history["status"] = "aborted"
+            self.conclude()
+
+    def _update(self, reply):
+        self.board.applyChanges(*reply["changes"])
+        self.scores = reply["scores"]
+        self.done, self.winner_id = reply["done"], reply["winner"]
+
+    def start(self):
+        players = [(u.connection_id, u.username) for u in self.users]
+        self.worker.matches += 1
+        d = self._call("create", self.match_id, players, self.board.size)
+        d.addCallback(self._started)
+
+    def _started(self, reply):
+        if reply is None:
+            return
+        self._update(reply)
+        Match.start(self)
+
+    def submitTurn(self, turn):
+        self.turnReceived(turn.player)
+        d = self._call("turn", self.match_id, turn.player.connection_id, turn.source, turn.dest)
+        d.addCallback(self._turnPlayed, turn.player)
+
+    def skipTurn(self, user):
+        d = self._call("skip", self.match_id, user.connection_id, user in self.forfeited)
+        d.addCallback(self._turnPlayed, user)
+
+    def _turnPlayed(self, reply, user):
+        if reply is None or self.concluded:
+            return
+        self.current_round += 1
+        self._update(reply)
+        t = metrics.clock()
+        self.broadcast()
+        metrics.lap("broadcast", t)
+        self.turnDone(user, reply["ok"], reply["message"])
+
+    def checkMatchFinished(self):
+        return self.done, self.getUserById(self.winner_id)
+
+    def legalMoves(self, user):
+        # the mirror board doesn't keep track of components on its own
+        self.board.relabel()
+        return Match.legalMoves(self, user)
+
+    def getPlayerSizes(self):
+        return dict((user, self.scores.get(user.connection_id, 0)) for user in self.users)
+
+    def addStateToHistory(self):
+        pass
+
+    def finalize(self):
+        self.logger.info("Finalize")
+        d = self._call("settle", self.match_id)
+        d.addCallback(self._settled)
+
+    def _settled(self, history):
+        if history is None or self.concluded:
+            return
+        self.history = history
+        self.conclude()
+
+    def conclude(self):
+        self.concluded = True
+        self.worker.matches -= 1
+        Match.conclude(self)
+
+    def removeUser(self, user):
+        asked = self.currentUser == user
+        if asked:
+            self.cancelDeadline()
+            self.nextUser()
+        self.users.remove(user)
+        d = self._call("remove", self.match_id, user.connection_id)
+
+        def removed(reply):
+            if reply is None or self.concluded:
+                return
+            self._update(reply)
+            if asked:
+                self.askCurrentUser()
+        d.addCallback(removed)
+
+
+class PlayerStats:
+    """
+    Aggregates over all fields of one owner, kept up to date by Board.setField().
+    Rows and columns count the owned fields per line, which makes the bounding
+    box cheap to find without looking at the board.
+    """
     def __init__(self, size):
-        self.values = np.zeros((size, size), dtype=np.uint16)
-        self.owner = np.zeros_like(self.values)
+        self.fields = 0
+        self.value = 0
+        self.rows = np.zeros(size, dtype=np.int32)
+        self.columns = np.zeros(size, dtype=np.int32)
+
+    def add(self, pos, value):
+        self.fields += 1
+        self.value += value
+        self.rows[pos[0]] += 1
+        self.columns[pos[1]] += 1
+
+    def addMany(self, index, value):
+        self.fields += len(index[0])
+        self.value += value
+        np.add.at(self.rows, index[0], 1)
+        np.add.at(self.columns, index[1], 1)
+
+    def remove(self, pos, value):
+        self.fields -= 1
+        self.value -= value
+        self.rows[pos[0]] -= 1
+        self.columns[pos[1]] -= 1
+
+    def removeMany(self, index, value):
+        self.fields -= len(index[0])
+        self.value -= value
+        np.subtract.at(self.rows, index[0], 1)
+        np.subtract.at(self.columns, index[1], 1)
+
+    def boundingBox(self):
+        if self.fields == 0:
+            return None
+        rows = np.flatnonzero(self.rows)
+        columns = np.flatnonzero(self.columns)
+        return (int(rows[0]), int(columns[0])), (int(rows[-1]), int(columns[-1]))
+
+
+class SparseGrid:
+    """
+    Stands in for a square two-dimensional NumPy array on large boards, where
+    nearly all fields are zero. Only non-zero fields are stored, keyed by flat
+    index. Food is spread evenly, so a tiled layout would end up with every tile
+    populated; per field storage keeps memory and populated() proportional to
+    the number of occupied fields.
+    Supports what the Board needs: single fields, index arrays, slices and
+    comparisons. Slices and comparisons produce dense arrays.
+    """
+    def __init__(self, shape, dtype):
+        self.size, _ = shape
+        self.shape = (self.size, self.size)
+        self.dtype = np.dtype(dtype)
+        self.fields = {}
+
+    def __len__(self):
+        return self.size
+
+    def _flat(self, x, y):
+        if not (0 <= x < self.size and 0 <= y < self.size):
+            raise IndexError("field {} out of bounds".format((x, y)))
+        return int(x) * self.size + int(y)
+
+    def _index(self, x, y):
+        if isinstance(x, slice) or isinstance(y, slice):
+            rows = np.atleast_1d(np.arange(self.size)[x])
+            columns = np.atleast_1d(np.arange(self.size)[y])
+            x, y = np.ix_(rows, columns)
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.intp), np.asarray(y, dtype=np.intp))
+        if x.size and (x.min() < 0 or y.min() < 0 or x.max() >= self.size or y.max() >= self.size):
+            raise IndexError("index out of bounds")
+        return x * self.size + y
+
+    def __getitem__(self, key):
+        x, y = key
+        if isinstance(x, (int, np.integer)) and isinstance(y, (int, np.integer)):
+            return self.dtype.type(self.fields.get(self._flat(x, y), 0))
+        index = self._index(x, y)
+        get = self.fields.get
+        return np.fromiter((get(i, 0) for i in index.ravel().tolist()), self.dtype, index.size).reshape(index.shape)
+
+    def __setitem__(self, key, value):
+        x, y = key
+        if isinstance(x, (int, np.integer)) and isinstance(y, (int, np.integer)):
+            index, value = self._flat(x, y), int(value)
+            if value:
+                self.fields[index] = value
+            else:
+                self.fields.pop(index, None)
+            return
+        index = self._index(x, y)
+        self.put(index, np.broadcast_to(np.asarray(value), index.shape))
+
+    def put(self, index, values):
+        """
+        Writes values to the fields at the given flat indices, like ndarray.put().
+        """
+        values = np.asarray(values).astype(self.dtype)
+        for i, v in zip(np.ravel(index).tolist(), np.ravel(values).tolist()):
+            if v:
+                self.fields[i] = v
+            else:
+                self.fields.pop(i, None)
+
+    def nonzero(self):
+        index = np.fromiter(self.fields, np.intp, len(self.fields))
+        index.sort()
+        return np.divmod(index, self.size)
+
+    def toarray(self):
+        array = np.zeros(self.shape, self.dtype)
+        index = np.fromiter(self.fields.keys(), np.intp, len(self.fields))
+        array.flat[index] = np.fromiter(self.fields.values(), self.dtype, len(self.fields))
+        return array
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.toarray()
+        return array if dtype is None else array.astype(dtype)
+
+    def astype(self, dtype):
+        return self.toarray().astype(dtype)
+
+    def tobytes(self):
+        return self.toarray().tobytes()
+
+    def any(self):
+        return bool(self.fields)
+
+    def __eq__(self, other):
+        return self.toarray() == other
+
+    def __ne__(self, other):
+        return self.toarray() != other
+
+    def __lt__(self, other):
+        return self.toarray() < other
+
+    def __le__(self, other):
+        return self.toarray() <= other
+
+    def __gt__(self, other):
+        return self.toarray() > other
+
+    def __ge__(self, other):
+        return self.toarray() >= other
+
+
+class Board:
+    def __init__(self, size, rng=None):
         self.size = size
+        self.sparse = size > DENSE_BOARD_SIZE
+        grid = SparseGrid if self.sparse else np.zeros
+        self.values = grid((size, size), np.uint16)
+        # owner slots, see addPlayer()
+        self.owner = grid((size, size), np.uint8)
+        self.slots = {NO_OWNER: NO_OWNER, FOOD_OWNER: FOOD_OWNER}
+        # slot -> player id, for translating owners at the protocol edge
+        self.slot_ids = np.array([NO_OWNER, FOOD_OWNER], dtype=np.uint16)
+        # Connected components of player owned fields, updated locally on every
+        # change made through setField(). 0 means "not part of any component".
+        self.labels = grid((size, size), np.uint32)
+        self.components = {}
+        self.player_components = {}
+        self.next_label = 1
+        # owner -> PlayerStats, for everything except NO_OWNER
+        self.stats = {}
+        # every field changed through setField(), in order; see changesSince().
+        # changes[0] has revision changes_base, trimChanges() drops older ones.
+        self.changes = []
+        self.changes_base = 0
+        # source of randomness for populate(), e.g. a seeded np.random.RandomState
+        self.rng = rng if rng is not None else np.random
 
     def adjacent(self, d):
         return [(d[0], d[1]+1), (d[0], d[1]-1), (d[0]+1, d[1]), (d[0]-1, d[1])]
 
+    def inside(self, d):
+        return 0 <= d[0] < self.size and 0 <= d[1] < self.size
+
+    def neighbors(self, d):
+        return [a for a in self.adjacent(d) if self.inside(a)]
+
     def random_free_field(self):
         while True:
-            x, y = np.random.randint(0, BOARD_SIZE-1), np.random.randint(0, BOARD_SIZE-1)
-            if self.owner[x][y] == NO_OWNER:
+            x, y = self.rng.randint(0, self.size-1), self.rng.randint(0, self.size-1)
+            if self.owner[x, y] == NO_OWNER:
                 return x, y
 
+    def addPlayer(self, player_id):
+        """
+        Returns the owner slot of a player, assigning the next free one to
+        players new to this board.
+        """
+        player_id = int(player_id)
+        if player_id not in self.slots:
+            slot = len(self.slot_ids)
+            if slot > MAX_PLAYER_SLOT:
+                raise ValueError("no owner slot left for player {}".format(player_id))
+            self.slots[player_id] = slot
+            self.slot_ids = np.append(self.slot_ids, np.uint16(player_id))
+        return self.slots[player_id]
+
+    def slotOf(self, player_id):
+        """
+        The owner slot of a player, NO_OWNER for players not on this board.
+        """
+        return self.slots.get(int(player_id), NO_OWNER)
+
+    def playerId(self, slot):
+        return int(self.slot_ids[slot])
+
+    def ownerIds(self, owner):
+        """
+        Translates owner slots, e.g. a slice of self.owner, to player ids.
+        """
+        return self.slot_ids[np.asarray(owner)]
+
+    def slotsOf(self, owner_ids):
+        """
+        Translates player ids to owner slots, the inverse of ownerIds().
+        """
+        owner_ids = np.asarray(owner_ids)
+        owner = np.zeros(owner_ids.shape, dtype=np.uint8)
+        for player_id, slot in self.slots.items():
+            owner[owner_ids == player_id] = slot
+        return owner
+
     def populate(self, users):
         for user in users:
+            slot = self.addPlayer(user.connection_id)
             start = self.random_free_field()
-            self.values[start] = 1
-            self.owner[start] = user.connection_id
-            self.values[start[0]+1,start[1]] = 1
-            self.owner[start[0]+1,start[1]] = user.connection_id
-        for food in range(np.random.poisson(int(FOOD_ABUNDANCE * BOARD_SIZE**2))):
-            field = self.random_free_field()
-            self.values[field] = 1
-            self.owner[field] = FOOD_OWNER
+            self.setField(start, slot, 1)
+            self.setField((start[0]+1, start[1]), slot, 1)
+        self.placeFood(self.rng.poisson(int(FOOD_ABUNDANCE * self.size**2)))
+
+    def placeFood(self, count):
+        """
+        Puts food of value 1 on count random free fields, drawn like
+        random_free_field() but all at once: a large board gets over a hundred
+        thousand of them.
+        """
+        count = min(count, (self.size-1)**2 - self.populatedCount())
+        index = np.zeros(0, dtype=np.intp)
+        while len(index) < count:
+            drawn = self.rng.randint(0, self.size-1, size=(2 * (count - len(index)) + 16, 2))
+            drawn = drawn[:, 0] * self.size + drawn[:, 1]
+            # keep the order of drawing, so the fields taken don't depend on their position
+            drawn, first = np.unique(np.concatenate((index, drawn)), return_index=True)
+            drawn = drawn[np.argsort(first)]
+            xs, ys = np.divmod(drawn, self.size)
+            index = drawn[self.owner[xs, ys] == NO_OWNER][:count]
+        xs, ys = np.divmod(index, self.size)
+        self.owner[xs, ys] = FOOD_OWNER
+        self.values[xs, ys] = 1
+        self._stats(FOOD_OWNER).addMany((xs, ys), len(index))
+        self.changes.extend(zip(xs.tolist(), ys.tolist()))
+
+    def setField(self, pos, owner, value):
+        """
+        Changes a single field. All modifications of populated fields must go
+        through here, so the component bookkeeping and statistics stay valid.
+        owner is a slot, like everything stored in self.owner.
+        """
+        pos = int(pos[0]), int(pos[1])
+        owner = int(owner)
+        value = int(value)
+        previous = int(self.owner[pos])
+        if previous != NO_OWNER:
+            self.stats[previous].remove(pos, int(self.values[pos]))
+        if owner != NO_OWNER:
+            self._stats(owner).add(pos, value)
+        self.changes.append(pos)
+        if previous != owner:
+            if previous >= FIRST_PLAYER_SLOT:
+                self._detach(pos, previous)
+            self.owner[pos] = owner
+            if owner >= FIRST_PLAYER_SLOT:
+                self._attach(pos, owner)
+        self.values[pos] = value
+
+    def relabel(self):
+        """
+        Rebuilds the component bookkeeping and statistics from scratch. Needed
+        after writing to the arrays directly, e.g. when restoring a board from a
+        snapshot.
+        """
+        self.labels[self.labels.nonzero()] = 0
+        self.components = {}
+        self.player_components = {}
+        self.stats = {}
+        for x, y in zip(*self.populated()):
+            pos, owner = (int(x), int(y)), int(self.owner[x, y])
+            self._stats(owner).add(pos, int(self.values[pos]))
+            if owner >= FIRST_PLAYER_SLOT:
+                self._attach(pos, owner)
+
+    def revision(self):
+        """
+        Returns a marker for the current state, to be passed to changesSince() later.
+        """
+        return self.changes_base + len(self.changes)
+
+    def changesSince(self, revision):
+        """
+        Returns the fields which were changed after the given revision, without
+        duplicates, or None if that part of the log was already trimmed.
+        """
+        if revision < self.changes_base:
+            return None
+        return list(dict.fromkeys(self.changes[revision - self.changes_base:]))
+
+    def trimChanges(self, revision):
+        """
+        Drops the changes up to the given revision, once no reader needs them.
+        Later revisions stay valid.
+        """
+        drop = revision - self.changes_base
+        if drop > 0:
+            del self.changes[:drop]
+            self.changes_base = revision
+
+    def exportChanges(self, revision):
+        """
+        Returns the fields changed after the given revision as flat indices plus
+        their current values and owner slots.
+        """
+        fields = np.array(self.changesSince(revision), dtype=np.intp).reshape((-1, 2))
+        xs, ys = fields[:, 0], fields[:, 1]
+        return xs * self.size + ys, self.values[xs, ys], self.owner[xs, ys]
+
+    def applyChanges(self, index, values, owner):
+        """
+        Writes fields exported by exportChanges() of another board. Only the
+        arrays and the change log are updated, which is all a mirror of a board
+        living in another process needs. Both boards must have the same players
+        in the same slots.
+        """
+        xs, ys = np.divmod(index, self.size)
+        self.values[xs, ys] = values
+        self.owner[xs, ys] = owner
+        self.changes.extend(zip(xs.tolist(), ys.tolist()))
+
+    def _stats(self, owner):
+        if owner not in self.stats:
+            self.stats[owner] = PlayerStats(self.size)
+        return self.stats[owner]
+
+    def fieldCount(self, owner: int):
+        stats = self.stats.get(int(owner))
+        return stats.fields if stats else 0
+
+    def playerValue(self, owner: int):
+        stats = self.stats.get(int(owner))
+        return stats.value if stats else 0
+
+    def boundingBox(self, owner: int):
+        """
+        Returns ((min_x, min_y), (max_x, max_y)) of the owner's fields, or None.
+        """
+        stats = self.stats.get(int(owner))
+        return stats.boundingBox() if stats else None
+
+    def players(self):
+        """
+        Returns the slots of all players which still own at least one field.
+        """
+        return [owner for owner, stats in self.stats.items() if owner >= FIRST_PLAYER_SLOT and stats.fields > 0]
+
+    def _newComponent(self, owner, fields):
+        label = self.next_label
+        self.next_label += 1
+        self.components[label] = fields
+        self.player_components.setdefault(owner, set()).add(label)
+        self._assignLabel(fields, label)
+        return label
+
+    def _assignLabel(self, fields, label):
+        if len(fields) == 1:
+            for field in fields:
+                self.labels[field] = label
+            return
+        xs, ys = zip(*fields)
+        self.labels[list(xs), list(ys)] = label
+
+    def _attach(self, pos, owner):
+        labels = set(int(self.labels[a]) for a in self.neighbors(pos) if self.owner[a] == owner) - {0}
+        if not labels:
+            self._newComponent(owner, {pos})
+            return
+        # merge everything into the largest touching component; relabeling only the
+        # smaller ones keeps the total work bounded by O(n log n) over a match
+        largest = max(labels, key=lambda label: len(self.components[label]))
+        target = self.components[largest]
+        for label in labels:
+            if label == largest:
+                continue
+            fields = self.components.pop(label)
+            self.player_components[owner].discard(label)
+            self._assignLabel(fields, largest)
+            target |= fields
+        target.add(pos)
+        self.labels[pos] = largest
+
+    def _detach(self, pos, owner):
+        label = int(self.labels[pos])
+        self.labels[pos] = 0
+        fields = self.components[label]
+        fields.discard(pos)
+        if not fields:
+            del self.components[label]
+            self.player_components[owner].discard(label)
+            return
+        starts = [a for a in self.neighbors(pos) if self.labels[a] == label]
+        if len(starts) < 2:
+            return
+        for piece in self._separate(label, starts):
+            fields -= piece
+            self._newComponent(owner, piece)
+
+    def _separate(self, label, starts, removed=None):
+        """
+        Finds out whether the fields in `starts` (all from component `label`) are
+        still connected, ignoring the field `removed`. Runs a breadth-first search
+        from every start simultaneously, merging searches which meet, and stops as
+        soon as only one search is left. The cost is thus bounded by the size of the
+        pieces which got cut off, not by the size of the component.
+        Returns the list of cut off pieces; empty if everything is still connected.
+        """
+        parent = list(range(len(starts)))
+        pieces = [{s} for s in starts]
+        frontiers = [deque([s]) for s in starts]
+        seen = dict((s, i) for i, s in enumerate(starts))
+        active = set(range(len(starts)))
+        closed = []
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        while len(active) > 1:
+            for i in list(active):
+                if i not in active or len(active) < 2:
+                    continue
+                if not frontiers[i]:
+                    closed.append(pieces[i])
+                    active.discard(i)
+                    continue
+                field = frontiers[i].popleft()
+                for a in self.neighbors(field):
+                    if a == removed or self.labels[a] != label:
+                        continue
+                    j = seen.get(a)
+                    if j is None:
+                        seen[a] = i
+                        pieces[i].add(a)
+                        frontiers[i].append(a)
+                        continue
+                    j = find(j)
+                    if j == i:
+                        continue
+                    big, small = (i, j) if len(pieces[i]) >= len(pieces[j]) else (j, i)
+                    pieces[big] |= pieces[small]
+                    frontiers[big].extend(frontiers[small])
+                    pieces[small] = frontiers[small] = None
+                    parent[small] = big
+                    active.discard(small)
+                    i = big
+        return closed
+
+    # the eight fields around a field, in circular order starting above it
+    RING = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+
+    def isArticulation(self, pos):
+        """
+        Tells whether removing the player owned field at pos would split its
+        component. Usually the 3x3 neighborhood decides it: if all allied direct
+        neighbors are linked around the field via allied corners, nothing can
+        fall apart. Only otherwise a bounded search is started.
+        """
+        label = self.labels[pos]
+        ring = []
+        for dx, dy in Board.RING:
+            a = pos[0]+dx, pos[1]+dy
+            ring.append(self.inside(a) and self.labels[a] == label)
+        # link each direct neighbor to the next one through the corner between them
+        parent = [0, 1, 2, 3]
+
+        def root(k):
+            while parent[k] != k:
+                k = parent[k]
+            return k
+
+        for k in range(4):
+            if ring[2*k] and ring[2*k+1] and ring[(2*k+2) % 8]:
+                parent[root((k+1) % 4)] = root(k)
+        starts = {}
+        for k in range(4):
+            if ring[2*k]:
+                dx, dy = Board.RING[2*k]
+                starts.setdefault(root(k), (pos[0]+dx, pos[1]+dy))
+        if len(starts) < 2:
+            return False
+        return len(self._separate(label, list(starts.values()), removed=pos)) > 0
+
+    def _ringSafe(self, fields):
+        """
+        The 3x3 test of isArticulation() for an (n, 2) array of player owned
+        fields at once: True where removing the field can't split its component.
+        False only means a search is needed.
+        """
+        ring = fields[:, None, :] + np.array(Board.RING)[None, :, :]
+        inside = ((ring >= 0) & (ring < self.size)).all(axis=2)
+        ring = np.clip(ring, 0, self.size - 1)
+        labels = self.labels[ring[..., 0], ring[..., 1]]
+        same = inside & (labels == self.labels[fields[:, 0], fields[:, 1]][:, None])
+        direct = same[:, 0::2]
+        # direct neighbor k and k+1 are linked through the corner between them
+        linked = (direct & same[:, 1::2] & np.roll(direct, -1, axis=1)).sum(axis=1)
+        groups = np.where(linked == 4, 1, direct.sum(axis=1) - linked)
+        return groups < 2
+
+    def articulationPoints(self, label):
+        """
+        Returns the set of fields of a component whose removal would split it,
+        using one iterative depth-first search (Tarjan).
+        """
+        fields = self.components[label]
+        start = next(iter(fields))
+        order = {start: 0}
+        low = {start: 0}
+        points = set()
+        root_children = 0
+        stack = [(start, None, iter(self.adjacent(start)))]
+        while stack:
+            pos, parent, around = stack[-1]
+            for a in around:
+                if a not in fields:
+                    continue
+                if a not in order:
+                    order[a] = low[a] = len(order)
+                    stack.append((a, pos, iter(self.adjacent(a))))
+                    break
+                if a != parent:
+                    low[pos] = min(low[pos], order[a])
+            else:
+                stack.pop()
+                if parent is None:
+                    continue
+                low[parent] = min(low[parent], low[pos])
+                if parent == start:
+                    root_children += 1
+                elif low[pos] >= order[parent]:
+                    points.add(parent)
+        if root_children > 1:
+            points.add(start)
+        return points
+
+    def legalMoves(self, player, sources=None):
+        """
+        Returns every move the player can make as two (n, 2) arrays of sources
+        and destinations, ordered by source. The rules are those of
+        Match.checkTurn(), evaluated for all pairs at once. As any own field can
+        feed any destination, the result grows with the product of the player's
+        size and its border; sources optionally restricts the fields to move from.
+        """
+        player = int(player)
+        none = np.zeros((0, 2), dtype=np.intp)
+        owned = [f for label in self.player_components.get(player, ()) for f in self.components[label]]
+        if not owned:
+            return none, none
+        owned = np.array(owned, dtype=np.intp)
+        flat_owned = owned[:, 0] * self.size + owned[:, 1]
+
+        # destinations are the own fields and everything next to them
+        around = owned[:, None, :] + np.array([(0, 1), (0, -1), (1, 0), (-1, 0)])[None, :, :]
+        by = np.repeat(flat_owned, 4)
+        around = around.reshape((-1, 2))
+        inside = ((around >= 0) & (around < self.size)).all(axis=1)
+        flat_around = around[inside, 0] * self.size + around[inside, 1]
+        dests = np.union1d(flat_owned, flat_around)
+        at = np.searchsorted(dests, flat_around)
+        # allied neighbors of each destination, and which one if there is only one
+        allies = np.bincount(at, minlength=len(dests))
+        ally = np.full(len(dests), -1, dtype=np.intp)
+        ally[at] = by[inside]
+        dx, dy = np.divmod(dests, self.size)
+        dest_owner = self.owner[dx, dy].astype(np.int64)
+        dest_value = self.values[dx, dy].astype(np.int64)
+        own = dest_owner == player
+        enemy = (dest_owner >= FIRST_PLAYER_SLOT) & ~own
+
+        if sources is None:
+            sources = owned
+        else:
+            sources = np.array(sources, dtype=np.intp).reshape((-1, 2))
+            sources = sources[((sources >= 0) & (sources < self.size)).all(axis=1)]
+            sources = sources[self.owner[sources[:, 0], sources[:, 1]] == player]
+        flat_sources = sources[:, 0] * self.size + sources[:, 1]
+        source_value = self.values[sources[:, 0], sources[:, 1]].astype(np.int64)
+        last = source_value == 1
+        movable = source_value > 0
+        # a field of strength 1 leaving must not split its component
+        search = np.flatnonzero(last)
+        search = search[~self._ringSafe(sources[search])]
+        points = {}
+        for i in search:
+            pos = int(sources[i, 0]), int(sources[i, 1])
+            label = int(self.labels[pos])
+            if label not in points:
+                points[label] = self.articulationPoints(label)
+            movable[i] = pos not in points[label]
+
+        # a field of strength 1 leaving can't be the only ally of its destination
+        stranded = (allies == 1)[None, :] & (ally[None, :] == flat_sources[:, None]) & last[:, None]
+        legal = movable[:, None] & (own[None, :] | ~stranded)
+        legal &= ~enemy[None, :] | (dest_value[None, :] + 1 <= source_value[:, None])
+        i, j = np.nonzero(legal)
+        return sources[i], np.stack((dx[j], dy[j]), axis=1)
+
+    def componentsOf(self, player: int):
+        """
+        Returns the labels of all components owned by the given player.
+        """
+        return list(self.player_components.get(int(player), ()))
+
+    def componentSize(self, label):
+        return len(self.components[label])
+
+    def removeComponent(self, label):
+        """
+        Clears all fields of a component and returns their summed value.
+        """
+        fields = self.components.pop(label)
+        xs, ys = zip(*fields)
+        index = list(xs), list(ys)
+        owner = int(self.owner[xs[0], ys[0]])
+        self.player_components[owner].discard(label)
+        self.changes.extend(fields)
+        total = int(np.sum(self.values[index]))
+        self.stats[owner].removeMany(index, total)
+        self.values[index] = 0
+        self.owner[index] = NO_OWNER
+        self.labels[index] = 0
+        return total
 
     def connected(self, pos):
         owner = self.owner[pos]
-        component = np.zeros_like(self.owner, dtype=np.bool)
+        if owner >= FIRST_PLAYER_SLOT:
+            component = self._mask()
+            self._assignMask(component, self.components[int(self.labels[pos])])
+            return component
+        return self.floodFill(pos)
+
+    def _mask(self):
+        # a SparseGrid on large boards, so masks cost as much as the fields they hold
+        return SparseGrid(self.owner.shape, bool) if self.sparse else np.zeros(self.owner.shape, dtype=bool)
+
+    def _assignMask(self, mask, fields):
+        xs, ys = zip(*fields)
+        mask[list(xs), list(ys)] = True
+
+    def _refuseEmpty(self, owner):
+        if self.sparse and owner == NO_OWNER:
+            raise ValueError("the empty fields of a sparse board cover nearly all of it")
+
+    def floodFill(self, pos):
+        pos = int(pos[0]), int(pos[1])
+        owner = self.owner[pos]
+        self._refuseEmpty(owner)
+        if self.sparse:
+            # breadth-first over the populated fields, instead of dilating a mask
+            fields = {pos}
+            frontier = deque(fields)
+            while frontier:
+                for a in self.neighbors(frontier.popleft()):
+                    if a not in fields and self.owner[a] == owner:
+                        fields.add(a)
+                        frontier.append(a)
+            component = self._mask()
+            self._assignMask(component, fields)
+            return component
+        component = np.zeros(self.owner.shape, dtype=bool)
         component[pos] = True
         interesting = self.owner == owner
         value = -1
@@ -494,131 +2171,683 @@ class Board:
         return component
 
     def playerContiguous(self, player: int):
-        field = np.where(self.owner == player)
-        field = field[0][0], field[1][0]
-        return (self.ownedByPlayer(player) == self.connected(field)).all()
+        return len(self.player_components.get(int(player), ())) <= 1
 
     def ownedByPlayer(self, player: int):
+        self._refuseEmpty(player)
+        if self.sparse:
+            owned = self._mask()
+            owned.fields = dict((i, True) for i, owner in self.owner.fields.items() if owner == player)
+            return owned
         return self.owner == player
 
+    def populatedCount(self):
+        return sum(stats.fields for stats in self.stats.values())
+
     def populated(self):
-        return np.where(self.owner != NO_OWNER)
+        # NO_OWNER is 0
+        return self.owner.nonzero()
+
+
+class RawCodec:
+    """
+    Board states without compression, only base64 encoded: the fastest choice
+    when disk space is cheaper than CPU time.
+    """
+    name = "none"
+    spec = "none"
+
+    def encode(self, buffers):
+        return binascii.b2a_base64(b"".join(buffers)).decode("utf8")
+
+    def decode(self, text):
+        return binascii.a2b_base64(text)
+
+
+class ZlibCodec:
+    """
+    Board states compressed with zlib at the given level. The arrays are fed to
+    the compressor as buffers, without joining them first.
+    """
+    name = "zlib"
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.level = level
+        self.spec = "zlib:{}".format(level)
+
+    def encode(self, buffers):
+        compressor = zlib.compressobj(self.level)
+        chunks = [compressor.compress(memoryview(b).cast("B")) for b in buffers]
+        chunks.append(compressor.flush())
+        return binascii.b2a_base64(b"".join(chunks)).decode("utf8")
+
+    def decode(self, text):
+        return zlib.decompress(binascii.a2b_base64(text))
+
+
+def stateCodec(spec):
+    """
+    Returns the codec for "none", "zlib" or "zlib:<level>".
+    """
+    name, _, level = spec.partition(":")
+    if name == "none" and not level:
+        return RawCodec()
+    if name == "zlib":
+        try:
+            level = int(level) if level else zlib.Z_DEFAULT_COMPRESSION
+        except ValueError:
+            level = None
+        if level is not None and -1 <= level <= 9:
+            return ZlibCodec(level)
+    raise ValueError("unknown codec {!r}".format(spec))
+
+
+# spectator streams and histories without a "codec" field use this one
+DEFAULT_CODEC = ZlibCodec()
 
 
 class MatchHistory:
-    def __init__(self):
+    """
+    Finished matches, stored as one JSON line each in match.db. Only the byte
+    offsets of the lines are kept in memory; matches are read from a memory map
+    of the file on request and held in a size-bounded LRU cache.
+    The offsets and per-player match lists are saved to a checkpoint next to
+    match.db, so a restart only has to read the matches added after it.
+    """
+    # codec for the states of new matches, see --history-codec
+    codec = stateCodec(HISTORY_CODEC)
+
+    def __init__(self, background=False):
         self.logger = logging.getLogger("MatchHistory")
         self.filename = "match.db"
-        self.matches = []
-        self.player_matches = {}
-        self.current_match_id = 0
-        self.loadMatchData()
+        self.checkpoint_filename = "match.db.index"
+        self.offsets = []
+        self.resetIndexes()
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        self.mapped = None
+        # False if the last line is incomplete, e.g. after a crash while writing
+        self.terminated = True
+        # a Deferred while matches are read in the background; matches added
+        # meanwhile are indexed once it fires
+        self.loading = None
+        self.unindexed = []
+        self.loadMatchData(background)
+        reactor.addSystemEventTrigger("before", "shutdown", self.saveCheckpoint)
+
+    @staticmethod
+    def codecOf(match):
+        """
+        Returns the codec the states of a match history were encoded with.
+        """
+        return stateCodec(match.get("codec", "zlib"))
 
     @staticmethod
-    def encodeState(values, owner):
-        data = values.tostring() + owner.tostring()
-        compressed = binascii.b2a_base64(zlib.compress(data)).decode("utf8")
-        return compressed
+    def encodeState(values, owner, owner_ids=None, codec=None):
+        """
+        owner_ids translates the owners if they are slots, see Board.ownerIds().
+        codec defaults to zlib, which is what spectator clients expect.
+        """
+        if owner_ids is not None:
+            owner = owner_ids[np.asarray(owner)]
+        codec = codec or DEFAULT_CODEC
+        return codec.encode([np.ascontiguousarray(values, np.uint16), np.ascontiguousarray(owner, np.uint16)])
 
     @staticmethod
-    def decodeState(board_size, compressed):
-        binary = zlib.decompress(binascii.a2b_base64(compressed))
-        values_raw = binary[:len(binary)//2]
-        owner_raw = binary[len(binary)//2:]
-        values = np.fromstring(values_raw, "uint16", board_size*board_size)
-        owner = np.fromstring(owner_raw, "uint16", board_size*board_size)
-        values.reshape((board_size, board_size))
-        owner.reshape((board_size, board_size))
+    def decodeState(board_size, compressed, codec=None):
+        """
+        Returns values and owner as read-only views of the decoded buffer; copy
+        them before making changes.
+        """
+        binary = (codec or DEFAULT_CODEC).decode(compressed)
+        cells = board_size * board_size
+        values = np.frombuffer(binary, np.uint16, cells).reshape((board_size, board_size))
+        owner = np.frombuffer(binary, np.uint16, cells, 2*cells).reshape((board_size, board_size))
         return values, owner
 
-    def loadMatchData(self):
-        self.matches = []
-        self.player_matches = {}
-        self.current_match_id = 0
-        self.logger.info("Loading matches…")
+    @staticmethod
+    def encodeDelta(values, owner, fields, owner_ids=None, codec=None):
+        """
+        Encodes the current content of the given fields, for storing only what
+        changed since the previous turn.
+        """
+        fields = np.array(fields, dtype=np.intp).reshape((-1, 2))
+        xs, ys = fields[:, 0], fields[:, 1]
+        index = (xs * values.shape[1] + ys).astype(np.uint32)
+        owner = owner[xs, ys] if owner_ids is None else owner_ids[owner[xs, ys]]
+        codec = codec or DEFAULT_CODEC
+        return codec.encode([index, values[xs, ys].astype(np.uint16, copy=False), owner.astype(np.uint16, copy=False)])
+
+    @staticmethod
+    def decodeDelta(compressed, codec=None):
+        binary = (codec or DEFAULT_CODEC).decode(compressed)
+        count = len(binary) // 8
+        index = np.frombuffer(binary, np.uint32, count)
+        values = np.frombuffer(binary, np.uint16, count, 4*count)
+        owner = np.frombuffer(binary, np.uint16, count, 6*count)
+        return index, values, owner
+
+    @staticmethod
+    def turnEntry(match, turn):
+        """
+        Returns (kind, data) for a turn of a match history, where kind is "K" for
+        full snapshots, "S" for snapshots of the populated fields of large boards
+        and "D" for deltas. Histories written before deltas were
+        introduced consist of snapshots only.
+        """
+        entry = match["turns"][turn]
+        if match.get("format", 1) < 2:
+            return "K", entry
+        return entry[0], entry[1:]
+
+    @staticmethod
+    def buildSeekIndex(match):
+        """
+        Returns the sorted list of turns which hold a full snapshot.
+        """
+        if match.get("format", 1) < 2:
+            return list(range(len(match["turns"])))
+        return [i for i, entry in enumerate(match["turns"]) if entry[0] in "KS"]
+
+    @staticmethod
+    def stateAt(match, turn, seek_index=None):
+        """
+        Rebuilds the board of a match history at the given turn by decoding the
+        closest snapshot before it and applying the deltas in between.
+        Returns (values, owner) as two-dimensional arrays, SparseGrids for
+        boards larger than DENSE_BOARD_SIZE.
+        """
+        if seek_index is None:
+            seek_index = MatchHistory.buildSeekIndex(match)
+        if turn < 0:
+            turn += len(match["turns"])
+        if not 0 <= turn < len(match["turns"]):
+            raise IndexError("turn {} out of range".format(turn))
+        keyframe = seek_index[bisect.bisect_right(seek_index, turn) - 1]
+        size = match["board_size"]
+        codec = MatchHistory.codecOf(match)
+        kind, data = MatchHistory.turnEntry(match, keyframe)
+        if kind == "S":
+            # sparse snapshots are deltas from an empty board
+            grid = SparseGrid if size > DENSE_BOARD_SIZE else np.zeros
+            values = grid((size, size), np.uint16)
+            owner = grid((size, size), np.uint16)
+            keyframe -= 1
+        else:
+            values, owner = MatchHistory.decodeState(size, data, codec)
+            values, owner = values.copy(), owner.copy()
+        for t in range(keyframe + 1, turn + 1):
+            index, delta_values, delta_owner = MatchHistory.decodeDelta(MatchHistory.turnEntry(match, t)[1], codec)
+            values.put(index, delta_values)
+            owner.put(index, delta_owner)
+        return values, owner
+
+    @staticmethod
+    def replayPages(match, match_id, first, last, page_size, seek_index=None):
+        """
+        Yields replay_page messages for the turns first to last of a match
+        history, page_size turns each. Turns are entries as written by
+        Match.addStateToHistory(); the first one is always a snapshot, so
+        playback can start at any turn. They are encoded with the codec named
+        in each page.
+        """
+        kind, data = MatchHistory.turnEntry(match, first)
+        if kind in "KS":
+            snapshot = kind + data
+        else:
+            values, owner = MatchHistory.stateAt(match, first, seek_index)
+            codec = MatchHistory.codecOf(match)
+            if match["board_size"] > DENSE_BOARD_SIZE:
+                snapshot = "S" + MatchHistory.encodeDelta(values, owner, np.stack(owner.nonzero(), axis=1), codec=codec)
+            else:
+                snapshot = "K" + MatchHistory.encodeState(values, owner, codec=codec)
+        for start in range(first, last + 1, page_size):
+            end = min(start + page_size, last + 1)
+            turns = ["".join(MatchHistory.turnEntry(match, t)) for t in range(start, end)]
+            if start == first:
+                turns[0] = snapshot
+            yield {"type": "replay_page", "match_id": match_id, "codec": match.get("codec", "zlib"),
+                   "first_turn": start, "turns": turns, "last": end > last}
+
+    def getState(self, match_id, turn):
+        """
+        Rebuilds the board of a stored match at the given turn.
+        """
+        match, seek_index = self._cached(match_id)
+        return MatchHistory.stateAt(match, turn, seek_index)
+
+    def getReplay(self, match_id, first, last, page_size):
+        match, seek_index = self._cached(match_id)
+        return MatchHistory.replayPages(match, match_id, first, last, page_size, seek_index)
+
+    def matchCount(self):
+        return len(self.offsets)
+
+    def getMatch(self, match_id):
+        """
+        Returns the history dict of a stored match, read from disk unless cached.
+        """
+        return self._cached(match_id)[0]
+
+    def _cached(self, match_id):
+        if match_id in self.cache:
+            self.cache.move_to_end(match_id)
+            return self.cache[match_id][:2]
+        if not 0 <= match_id < len(self.offsets):
+            raise IndexError("match {} not found".format(match_id))
+        start, length = self.offsets[match_id]
+        match = json.loads(self._read(start, length).decode("utf8"))
+        entry = match, MatchHistory.buildSeekIndex(match), length
+        self.cache[match_id] = entry
+        self.cache_size += length
+        while self.cache_size > MATCH_CACHE_SIZE and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_size -= evicted[2]
+        return entry[:2]
+
+    def _read(self, start, length):
+        if self.mapped is None or start + length > len(self.mapped):
+            # the file grew since it was mapped
+            if self.mapped is not None:
+                self.mapped.close()
+            with open(self.filename, "rb") as f:
+                self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mapped[start:start+length]
+
+    def loadMatchData(self, background=False):
+        """
+        Restores the indexes from the checkpoint and reads the matches written
+        after it, all of match.db if there is no valid checkpoint. In the
+        background, the file is read a few lines per reactor iteration.
+        """
+        self.offsets = []
+        self.resetIndexes()
+        self.cache.clear()
+        self.cache_size = 0
+        self.unindexed = []
         try:
-            with open(self.filename) as f:
-                for line in f:
-                    match = json.loads(line)
-                    self.addMatch(match, False)
-            self.logger.info(" … done! {} matches loaded".format(self.current_match_id))
+            with open(self.filename, "rb") as f:
+                end = f.seek(0, os.SEEK_END)
+                if end > 0:
+                    f.seek(end - 1)
+                    self.terminated = f.read(1) == b"\n"
         except IOError as e:
             self.logger.info(" cannot open database. {}".format(str(e)))
+            return
+        start = self.loadCheckpoint(end)
+        self.logger.info("Loading matches from byte {} of {}…".format(start, end))
+        scan = self._scan(start, end)
+        if background and start < end:
+            self.loading = task.cooperate(scan).whenDone()
+            self.loading.addCallback(self._loaded)
+        else:
+            for _ in scan:
+                pass
+            self._loaded(None)
+
+    def _scan(self, start, end):
+        with open(self.filename, "rb") as f:
+            f.seek(start)
+            offset = start
+            while offset < end:
+                line = f.readline()
+                if not line:
+                    return
+                try:
+                    match = json.loads(line.decode("utf8"))
+                except ValueError:
+                    self.logger.warning(" skipping unreadable entry at byte {}".format(offset))
+                else:
+                    self._index(match, offset, len(line), bulk=True)
+                offset += len(line)
+                yield
+
+    def _loaded(self, result):
+        self.loading = None
+        for match_history, offset, length in self.unindexed:
+            self._index(match_history, offset, length, bulk=True)
+        self.unindexed = []
+        self.sortIndexes()
+        self.logger.info(" … done! {} matches loaded".format(self.current_match_id))
+        self.saveCheckpoint()
+
+    def _tailChecksum(self, f, size):
+        f.seek(max(0, size - CHECKPOINT_TAIL))
+        return zlib.crc32(f.read(min(size, CHECKPOINT_TAIL)))
+
+    def loadCheckpoint(self, file_size):
+        """
+        Restores the indexes from the checkpoint if it still fits match.db and
+        returns the number of bytes it covers, else 0.
+        """
+        try:
+            with open(self.checkpoint_filename, "rb") as f:
+                checkpoint = pickle.load(f)
+            size = checkpoint["size"]
+            if size > file_size:
+                raise ValueError("match.db is smaller than the checkpoint")
+            with open(self.filename, "rb") as f:
+                if self._tailChecksum(f, size) != checkpoint["tail"]:
+                    raise ValueError("match.db was changed")
+            offsets, summaries = checkpoint["offsets"], checkpoint["summaries"]
+        except IOError:
+            return 0
+        except Exception as e:
+            self.logger.warning("Ignoring match history checkpoint: {}".format(str(e)))
+            return 0
+        self.offsets = [tuple(o) for o in offsets.tolist()]
+        for summary in summaries:
+            self._summarize(summary, bulk=True)
+        self.sortIndexes()
+        return size
+
+    def saveCheckpoint(self):
+        if self.loading is not None:
+            return
+        try:
+            with open(self.filename, "rb") as f:
+                size = f.seek(0, os.SEEK_END)
+                tail = self._tailChecksum(f, size)
+        except IOError:
+            return
+        checkpoint = {
+            "size": size,
+            "tail": tail,
+            "offsets": np.array(self.offsets, dtype=np.int64).reshape((-1, 2)),
+            "summaries": self.summaries
+        }
+        temporary = self.checkpoint_filename + ".tmp"
+        with open(temporary, "wb") as f:
+            pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.checkpoint_filename)
+
+    def resetIndexes(self):
+        # per match id: (users, winner, status, number of turns, finish time)
+        self.summaries = []
+        # secondary indexes, lists of match ids in ascending order
+        self.player_matches = {}
+        self.pair_matches = {}
+        self.winner_matches = {}
+        self.status_matches = {}
+        # sorted (value, match id) lists for range queries; bulk loads append
+        # and leave sorting to sortIndexes()
+        self.length_index = []
+        self.finish_index = []
+        self.indexes_sorted = True
+        self.current_match_id = 0
+
+    def _index(self, match_history, offset, length, bulk=False):
+        self.offsets.append((offset, length))
+        self._summarize((tuple(match_history["users"]), match_history.get("winner"), match_history.get("status"),
+                         len(match_history.get("turns", [])), match_history.get("finished_at")), bulk)
 
-    def addMatch(self, match_history, save_to_file=True):
-        self.matches.append(match_history)
-        for p in match_history["users"]:
+    def _summarize(self, summary, bulk=False):
+        users, winner, status, turns, finished_at = summary
+        match_id = self.current_match_id
+        self.summaries.append(summary)
+        for p in users:
             if p in self.player_matches:
-                self.player_matches[p].append(self.current_match_id)
+                self.player_matches[p].append(match_id)
             else:
-                self.player_matches[p] = [self.current_match_id]
-        if save_to_file:
-            with open(self.filename, "a") as f:
-                f.write(json.dumps(match_history)+"\n")
+                self.player_matches[p] = [match_id]
+        for pair in itertools.combinations(sorted(set(users)), 2):
+            self.pair_matches.setdefault(pair, []).append(match_id)
+        self.winner_matches.setdefault(winner, []).append(match_id)
+        self.status_matches.setdefault(status, []).append(match_id)
+        if bulk:
+            self.length_index.append((turns, match_id))
+            if finished_at is not None:
+                self.finish_index.append((finished_at, match_id))
+            self.indexes_sorted = False
+        else:
+            self.sortIndexes()
+            bisect.insort(self.length_index, (turns, match_id))
+            if finished_at is not None:
+                bisect.insort(self.finish_index, (finished_at, match_id))
         self.current_match_id += 1
 
+    def sortIndexes(self):
+        """
+        Sorts the range indexes after a bulk load, once instead of per match.
+        """
+        if not self.indexes_sorted:
+            self.length_index.sort()
+            self.finish_index.sort()
+            self.indexes_sorted = True
+
+    def summary(self, match_id):
+        users, winner, status, turns, finished_at = self.summaries[match_id]
+        return {"match_id": match_id, "users": list(users), "winner": winner, "status": status,
+                "turns": turns, "finished_at": finished_at}
+
+    def query(self, filters, cursor=None, limit=QUERY_PAGE_SIZE):
+        """
+        Returns the ids of the matches passing all filters, newest first and
+        older than cursor if given, and the cursor of the next page (None on the
+        last page). Filters are user, opponent, winner (None for draws),
+        status, min_turns, max_turns, since and until (finish time). The
+        matches are taken from the shortest index that applies.
+        """
+        # matches read in the background may have been appended unsorted
+        self.sortIndexes()
+        sources = []
+        user, opponent = filters.get("user"), filters.get("opponent")
+        if user is not None and opponent is not None and user != opponent:
+            sources.append(self.pair_matches.get(tuple(sorted((user, opponent))), []))
+        elif user is not None or opponent is not None:
+            sources.append(self.player_matches.get(user if user is not None else opponent, []))
+        if "winner" in filters:
+            sources.append(self.winner_matches.get(filters["winner"], []))
+        if "status" in filters:
+            sources.append(self.status_matches.get(filters["status"], []))
+        ranges = []
+        for index, low, high in ((self.length_index, filters.get("min_turns"), filters.get("max_turns")),
+                                 (self.finish_index, filters.get("since"), filters.get("until"))):
+            if low is not None or high is not None:
+                start = 0 if low is None else bisect.bisect_left(index, (low,))
+                end = len(index) if high is None else bisect.bisect_right(index, (high, float("inf")))
+                ranges.append((index, start, end))
+        source = min(sources, key=len) if sources else range(self.current_match_id)
+        for index, start, end in ranges:
+            if end - start < len(source):
+                source = sorted(match_id for value, match_id in index[start:end])
+        position = len(source) if cursor is None else bisect.bisect_left(source, cursor)
+        ids = []
+        for match_id in (source[i] for i in range(position - 1, -1, -1)):
+            if self._passes(match_id, filters):
+                ids.append(match_id)
+                if len(ids) > limit:
+                    return ids[:limit], ids[limit - 1]
+        return ids, None
+
+    def _passes(self, match_id, filters):
+        users, winner, status, turns, finished_at = self.summaries[match_id]
+        for key in ("user", "opponent"):
+            if filters.get(key) is not None and filters[key] not in users:
+                return False
+        if "winner" in filters and winner != filters["winner"]:
+            return False
+        if "status" in filters and status != filters["status"]:
+            return False
+        if filters.get("min_turns") is not None and turns < filters["min_turns"]:
+            return False
+        if filters.get("max_turns") is not None and turns > filters["max_turns"]:
+            return False
+        if filters.get("since") is not None or filters.get("until") is not None:
+            if finished_at is None:
+                return False
+            if filters.get("since") is not None and finished_at < filters["since"]:
+                return False
+            if filters.get("until") is not None and finished_at > filters["until"]:
+                return False
+        return True
+
+    def addMatch(self, match_history):
+        t = metrics.clock()
+        line = (json.dumps(match_history)+"\n").encode("utf8")
+        with open(self.filename, "ab") as f:
+            if not self.terminated:
+                f.write(b"\n")
+                self.terminated = True
+            offset = f.tell()
+            f.write(line)
+        metrics.lap("match_write", t)
+        if self.loading is not None:
+            self.unindexed.append((match_history, offset, len(line)))
+        else:
+            self._index(match_history, offset, len(line))
+
 
-class Spectator(protocol.Protocol):
+class Spectator(Connection):
     def __init__(self, lobby, addr):
         self.logger = logging.getLogger("Spectator({})".format(str(addr)))
         self.lobby = lobby
         self.addr = addr
-        self.watchedMatch = None
+        # "follow" moves on to the next match, "match" watches one match, "all" every match
+        self.mode = None
+        # watched match -> time its last frame was written
+        self.watched = {}
+        self.min_interval = 0
+        # while the transport's buffer is full or a match is throttled, only the latest
+        # stream frame per match is kept
+        self.congested = False
+        self.pending = OrderedDict()
+        self.timers = {}
+        self.dropped_frames = 0
+        # pages of a running historic match replay
+        self.replay = None
+        self.replay_call = None
 
     def startSpectating(self, match):
-        assert(self.watchedMatch is None)
-        self.watchedMatch = match
+        if match in self.watched:
+            return
+        self.watched[match] = 0
         try:
             self.lobby.waiting_spectators.remove(self)
         except ValueError:
             pass
-        self.watchedMatch.spectators.append(self)
-        self._sendMessage({"type":"start_stream"})
-
-    def streamFinished(self):
-        self._sendMessage({"type":"stream_finished", "message":"Match is finished."})
+        match.spectators.append(self)
+        self._sendMessage({"type":"start_stream", "match_id":match.match_id, "users":match.history["users"]})
+
+    def streamFinished(self, match):
+        timer = self.timers.pop(match, None)
+        if timer is not None:
+            timer.cancel()
+        frame = self.pending.pop(match, None)
+        if frame is not None:
+            self._write(frame)
+        self._sendMessage({"type":"stream_finished", "match_id":match.match_id, "message":"Match is finished."})
         try:
-            self.watchedMatch.spectators.remove(self)
+            match.spectators.remove(self)
         except ValueError:
             pass
-        self.watchedMatch = None
+        self.watched.pop(match, None)
 
     def stopSpectating(self):
-        if self.watchedMatch:
-            self.watchedMatch.spectators.remove(self)
-            self.watchedMatch = None
-        try:
-            self.lobby.waiting_spectators.remove(self)
-        except ValueError:
-            pass
+        for match in self.watched:
+            match.spectators.remove(self)
+        for timer in self.timers.values():
+            timer.cancel()
+        self.watched.clear()
+        self.timers.clear()
+        self.pending.clear()
+        for spectators in (self.lobby.waiting_spectators, self.lobby.all_spectators):
+            try:
+                spectators.remove(self)
+            except ValueError:
+                pass
+        self.mode = None
 
     def connectionLost(self, reason):
         self.logger.info("Spectator disconnected")
         self.stopSpectating()
-
-    def dataReceived(self, rawdata):
-        try:
-            data = json.loads(rawdata.decode("utf8"))
-        except Exception as e:
-            self._sendErrorResponse("Error while parsing JSON package: {}".format(str(e)))
+        self.stopReplay()
+
+    def startReplay(self, pages):
+        self.stopReplay()
+        self.replay = pages
+        self._pumpReplay()
+
+    def stopReplay(self):
+        if self.replay_call is not None and self.replay_call.active():
+            self.replay_call.cancel()
+        self.replay_call = None
+        self.replay = None
+
+    def _pumpReplay(self):
+        """
+        Sends the next replay page. The one after it follows in the next reactor
+        iteration, or once the transport's buffer drained.
+        """
+        self.replay_call = None
+        if self.replay is None or self.congested:
             return
+        page = next(self.replay, None)
+        if page is None:
+            self.replay = None
+            return
+        self._sendMessage(page)
+        self.replay_call = reactor.callLater(0, self._pumpReplay)
+
+    def pauseProducing(self):
+        # the transport's buffer is full
+        Connection.pauseProducing(self)
+        self.congested = True
+
+    def resumeProducing(self):
+        self.congested = False
+        for match in list(self.pending):
+            if self.congested:
+                break
+            self._deliver(match)
+        if self.replay is not None and self.replay_call is None:
+            self._pumpReplay()
+        Connection.resumeProducing(self)
+
+    def requestParseFailed(self, e):
+        self._sendErrorResponse("Error while parsing JSON package: {}".format(str(e)))
+
+    def handleRequest(self, data):
         try:
-            if "type" not in data:
+            if not isinstance(data, dict) or "type" not in data:
                 self._sendErrorResponse("Required 'type' field not found.")
                 return
-            if data["type"] == "get_historic_match":
+            if data["type"] == "set_protocol":
+                self.setProtocol(data)
+            elif data["type"] == "get_historic_match":
                 if "match_id" not in data:
                     self._sendErrorResponse("match_id not supplied.")
                     return
                 mid = data["match_id"]
-                if mid >= len(self.lobby.history.matches) or mid < 0:
+                if mid >= self.lobby.history.matchCount() or mid < 0:
+                    self._sendErrorResponse("404 match not found.")
+                    return
+                self._sendSuccessResponse(message="Fuck yes.", match=self.lobby.history.getMatch(mid))
+            elif data["type"] == "replay_match":
+                mid = data.get("match_id")
+                if not isinstance(mid, int) or not 0 <= mid < self.lobby.history.matchCount():
                     self._sendErrorResponse("404 match not found.")
                     return
-                self._sendSuccessResponse(message="Fuck yes.", match=self.lobby.history.matches[mid])
+                match = self.lobby.history.getMatch(mid)
+                turn_count = len(match["turns"])
+                first = data.get("from_turn", 0)
+                last = data.get("to_turn", turn_count - 1)
+                page_size = data.get("page_size", REPLAY_PAGE_SIZE)
+                if not isinstance(first, int) or not isinstance(last, int) or not 0 <= first <= last < turn_count:
+                    self._sendErrorResponse("Turn range must be within 0 and {}.".format(turn_count - 1))
+                    return
+                if not isinstance(page_size, int) or not 0 < page_size <= MAX_REPLAY_PAGE_SIZE:
+                    self._sendErrorResponse("page_size must be between 1 and {}.".format(MAX_REPLAY_PAGE_SIZE))
+                    return
+                info = dict((key, value) for key, value in match.items() if key != "turns")
+                # a new replay replaces a running one, e.g. when the viewer seeks
+                self._sendSuccessResponse(message="Replaying.", match=info, match_id=mid, turn_count=turn_count,
+                                          from_turn=first, to_turn=last, page_size=page_size)
+                self.startReplay(self.lobby.history.getReplay(mid, first, last, page_size))
             elif data["type"] == "get_historic_match_list":
                 if "by_user" in data:
                     user = data["by_user"]
-                    if user not in self.lobby.user_db.keys():
+                    if user not in self.lobby.user_db:
                         self._sendErrorResponse("Unknown user.")
                         return
                     player_matches = self.lobby.history.player_matches
@@ -627,54 +2856,166 @@ class Spectator(protocol.Protocol):
                         matches = player_matches[user]
                     self._sendSuccessResponse(message="Got it.", matches=matches)
                 else:
-                    matches = list(range(len(self.lobby.history.matches)))
+                    matches = list(range(self.lobby.history.matchCount()))
                     self._sendSuccessResponse(message="Got it.", matches=matches)
+            elif data["type"] == "query_matches":
+                filters = dict((key, data[key]) for key in ("user", "opponent", "winner", "status", "min_turns",
+                                                            "max_turns", "since", "until") if key in data)
+                for key in ("user", "opponent", "status"):
+                    if key in filters and not isinstance(filters[key], str):
+                        self._sendErrorResponse("{} must be a string.".format(key))
+                        return
+                if "winner" in filters and not isinstance(filters["winner"], (str, type(None))):
+                    self._sendErrorResponse("winner must be a string, or null for draws.")
+                    return
+                for key in ("min_turns", "max_turns", "since", "until"):
+                    if key in filters and not isinstance(filters[key], (int, float)):
+                        self._sendErrorResponse("{} must be a number.".format(key))
+                        return
+                cursor = data.get("cursor")
+                limit = data.get("limit", QUERY_PAGE_SIZE)
+                if cursor is not None and not isinstance(cursor, int):
+                    self._sendErrorResponse("cursor must be a match id.")
+                    return
+                if not isinstance(limit, int) or not 0 < limit <= MAX_QUERY_PAGE_SIZE:
+                    self._sendErrorResponse("limit must be between 1 and {}.".format(MAX_QUERY_PAGE_SIZE))
+                    return
+                history = self.lobby.history
+                ids, next_cursor = history.query(filters, cursor, limit)
+                self._sendSuccessResponse(message="Got it.", matches=[history.summary(i) for i in ids],
+                                          next_cursor=next_cursor, loading=history.loading is not None)
+            elif data["type"] == "get_leaderboard":
+                leaderboard = self.lobby.user_db.leaderboard
+                count = data.get("count", LEADERBOARD_PAGE_SIZE)
+                if not isinstance(count, int) or not 0 < count <= MAX_LEADERBOARD_PAGE_SIZE:
+                    self._sendErrorResponse("count must be between 1 and {}.".format(MAX_LEADERBOARD_PAGE_SIZE))
+                    return
+                kwargs = {}
+                start = 0
+                if "user" in data:
+                    if data["user"] not in leaderboard:
+                        self._sendErrorResponse("Unknown user.")
+                        return
+                    rank = leaderboard.rank(data["user"])
+                    kwargs["user"] = {"rank": rank + 1, "name": data["user"], "rating": leaderboard.ratings[data["user"]]}
+                    # without a start rank, the page is centered on the user
+                    start = max(0, rank - count // 2)
+                if "start" in data:
+                    if not isinstance(data["start"], int) or data["start"] < 1:
+                        self._sendErrorResponse("start must be a rank, starting at 1.")
+                        return
+                    start = data["start"] - 1
+                entries = [{"rank": rank + 1, "name": name, "rating": rating}
+                           for rank, name, rating in leaderboard.page(start, count)]
+                self._sendSuccessResponse(message="Got it.", entries=entries, total=len(leaderboard), **kwargs)
             elif data["type"] == "get_users":
-                users = {}
-                disallowed_keys = ["password"]
                 # no password :P
-                for user, data in self.lobby.user_db.items():
-                    users[user] = dict(
-                        (key, val) for key, val in data.items() if key not in disallowed_keys
-                    )
+                users = self.lobby.user_db.publicRecords()
                 self._sendSuccessResponse(message="Yessir.", users=users)
+            elif data["type"] == "list_matches":
+                matches = [{
+                    "match_id": match.match_id,
+                    "users": match.history["users"],
+                    "round": match.current_round,
+                    "spectators": len(match.spectators)
+                } for match in self.lobby.activeMatches]
+                self._sendSuccessResponse(message="Got it.", matches=matches)
+            elif data["type"] == "get_stats":
+                if not metrics.enabled:
+                    self._sendErrorResponse("Metrics are disabled, start the server with --metrics.")
+                    return
+                self._sendSuccessResponse(message="Got it.", stats=metrics.snapshot())
             elif data["type"] == "stream_game":
-                self.logger.info("Start game streaming")
-                self.lobby.addSpectator(self)
+                max_fps = data.get("max_fps", SPECTATOR_MAX_FPS if data.get("all") else None)
+                if max_fps is not None and (not isinstance(max_fps, (int, float)) or max_fps <= 0):
+                    self._sendErrorResponse("max_fps must be a positive number.")
+                    return
+                match = None
+                if "match_id" in data:
+                    match = self.lobby.findMatch(data["match_id"])
+                    if match is None:
+                        self._sendErrorResponse("404 match not found.")
+                        return
+                self.stopSpectating()
+                self.min_interval = 1.0 / max_fps if max_fps else 0
+                if match is not None:
+                    self.logger.info("Start streaming match {}".format(match.match_id))
+                    self.mode = "match"
+                    self.startSpectating(match)
+                elif data.get("all"):
+                    self.logger.info("Start streaming all matches")
+                    self.mode = "all"
+                    self.lobby.watchAll(self)
+                else:
+                    self.logger.info("Start game streaming")
+                    self.mode = "follow"
+                    self.lobby.addSpectator(self)
             else:
                 self._sendErrorResponse("Unknown request.")
         except Exception as e:
             self._sendErrorResponse("Server Error :/")
             self.logger.error("Error while processing spectator request: {}".format(str(e)))
 
-    def sendActiveMatch(self, match):
-        pkg = { "type": "stream_turn" }
-        pkg.update(match.history)
-        pkg["score"] = match.getCurrentScore()
-        pkg["turn"] = pkg["turns"][-1]
-        del pkg["turns"]
-        self._sendMessage(pkg)
-
-    def _sendMessage(self, data):
-        self.transport.write(json.dumps(data).encode("utf8")+b"\n")
+    def framing(self):
+        return self.frames is not None, self.compress_frames
 
-    def _sendErrorResponse(self, message, **kwargs):
+    @staticmethod
+    def encodeStreamTurn(match, binary, compress):
         pkg = {
-            "type": "response",
-            "status": "failure",
-            "message": message
+            "type": "stream_turn",
+            "match_id": match.match_id,
+            "users": match.history["users"],
+            "board_size": match.board.size,
+            "status": match.history["status"],
+            "winner": match.history["winner"],
+            "score": match.getCurrentScore()
         }
-        pkg.update(kwargs)
-        self._sendMessage(pkg)
+        board = match.board
+        if board.sparse:
+            # large boards only send their populated fields, as flat index, value and owner
+            pkg["sparse"] = True
+            xs, ys = board.populated()
+            if binary:
+                index = (xs * board.size + ys).astype(np.uint32)
+                return wire.encodeFrame(pkg, {"index": index, "values": board.values[xs, ys],
+                                              "owner": board.ownerIds(board.owner[xs, ys])}, compress)
+            pkg["turn"] = MatchHistory.encodeDelta(board.values, board.owner, np.stack((xs, ys), axis=1), board.slot_ids)
+            return json.dumps(pkg).encode("utf8")+b"\n"
+        if binary:
+            return wire.encodeFrame(pkg, {"values": board.values, "owner": board.ownerIds(board.owner)}, compress)
+        pkg["turn"] = MatchHistory.encodeState(board.values, board.owner, board.slot_ids)
+        return json.dumps(pkg).encode("utf8")+b"\n"
+
+    def sendFrame(self, match, frame):
+        if match not in self.watched:
+            return
+        if match in self.pending:
+            self.dropped_frames += 1
+            metrics.count("dropped_frames")
+        self.pending[match] = frame
+        self._deliver(match)
+
+    def _deliver(self, match):
+        """
+        Writes the held frame of a match, or leaves it pending until the buffer
+        drains or the match's frame interval has passed.
+        """
+        if self.congested or match in self.timers or match not in self.pending:
+            return
+        now = reactor.seconds()
+        wait = self.watched[match] + self.min_interval - now
+        if wait > 0:
+            self.timers[match] = reactor.callLater(wait, self._release, match)
+            return
+        self.watched[match] = now
+        self._write(self.pending.pop(match))
 
-    def _sendSuccessResponse(self, message="Ok.", **kwargs):
-        pkg = {
-            "type": "response",
-            "status": "success",
-            "message": message
-        }
-        pkg.update(kwargs)
-        self._sendMessage(pkg)
+    def _release(self, match):
+        del self.timers[match]
+        self._deliver(match)
+
+    def sendActiveMatch(self, match):
+        self.sendFrame(match, Spectator.encodeStreamTurn(match, *self.framing()))
 
 
 class SpectatorFactory(protocol.Factory):
@@ -685,7 +3026,180 @@ class SpectatorFactory(protocol.Factory):
         return Spectator(self.lobby, addr)
 
 
+class MetricsResource(resource.Resource):
+    """
+    Serves Metrics.render() to Prometheus.
+    """
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4; charset=utf-8")
+        return metrics.render().encode("utf8")
+
+
+class MatchWorker:
+    """
+    Runs matches inside a worker process. Requests arrive as pickled tuples
+    (command, match_id, arguments...) and are answered in order, see WorkerProcess.
+    """
+    def __init__(self):
+        self.matches = {}
+        self.revisions = {}
+
+    def _reply(self, match_id, **kwargs):
+        match = self.matches[match_id]
+        changes = match.board.exportChanges(self.revisions[match_id])
+        self.revisions[match_id] = match.board.revision()
+        match.trimChanges(self.revisions[match_id])
+        done, winner = match.checkMatchFinished()
+        kwargs.update({
+            "changes": changes,
+            "scores": dict((u.connection_id, size) for u, size in match.getPlayerSizes().items()),
+            "done": done,
+            "winner": winner.connection_id if winner else None
+        })
+        return kwargs
+
+    def create(self, match_id, players, board_size):
+        users = [Player(connection_id, username) for connection_id, username in players]
+        board = Board(board_size)
+        board.populate(users)
+        self.matches[match_id] = Match(users, board, None, match_id)
+        self.revisions[match_id] = 0
+        return self._reply(match_id)
+
+    def turn(self, match_id, connection_id, source, dest):
+        match = self.matches[match_id]
+        player = match.getUserById(connection_id)
+        ok, message = match.checkedTurn(Turn(source, dest, player))
+        if ok:
+            player.consecutive_failed_turns = 0
+        else:
+            player.consecutive_failed_turns += 1
+        return self._reply(match_id, ok=ok, message=message)
+
+    def skip(self, match_id, connection_id, forfeit):
+        match = self.matches[match_id]
+        player = match.getUserById(connection_id)
+        match.skippedTurn()
+        player.consecutive_failed_turns += 1
+        if forfeit:
+            match.forfeited.add(player)
+        return self._reply(match_id, ok=False, message="turn timed out")
+
+    def remove(self, match_id, connection_id):
+        match = self.matches[match_id]
+        match.removeUser(match.getUserById(connection_id))
+        return self._reply(match_id)
+
+    def settle(self, match_id):
+        match = self.matches.pop(match_id)
+        del self.revisions[match_id]
+        match.settle()
+        return match.history
+
+    def serve(self, stdin, stdout):
+        while True:
+            head = stdin.read(wire.PREFIX.size)
+            if len(head) < wire.PREFIX.size:
+                return
+            length, = wire.PREFIX.unpack(head)
+            command, *args = pickle.loads(stdin.read(length))
+            try:
+                reply = getattr(self, command)(*args)
+            except Exception as e:
+                logging.getLogger("MatchWorker").exception("Error in {}".format(command))
+                reply = WorkerError("{}: {}".format(type(e).__name__, str(e)))
+            data = pickle.dumps(reply, pickle.HIGHEST_PROTOCOL)
+            stdout.write(wire.PREFIX.pack(len(data)) + data)
+            stdout.flush()
+
+
+class WorkerError(Exception):
+    pass
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    Reactor side of one worker process running `blobs.py --worker`. Requests
+    are length-prefixed pickles on its stdin; since the worker answers strictly
+    in order, each reply fires the oldest pending Deferred.
+    """
+    def __init__(self, index):
+        self.logger = logging.getLogger("WorkerProcess({})".format(index))
+        self.frames = wire.FrameReader(2**31)
+        self.pending = deque()
+        self.matches = 0
+        reactor.spawnProcess(self, sys.executable, [sys.executable, os.path.abspath(__file__), "--worker",
+                                                     "--history-codec", MatchHistory.codec.spec],
+                             env=os.environ, childFDs={0: "w", 1: "r", 2: 2})
+
+    def call(self, *request):
+        d = defer.Deferred()
+        if self.transport is None:
+            d.errback(WorkerError("worker not running"))
+            return d
+        self.pending.append(d)
+        data = pickle.dumps(request, pickle.HIGHEST_PROTOCOL)
+        self.transport.write(wire.PREFIX.pack(len(data)) + data)
+        return d
+
+    def outReceived(self, data):
+        for body in self.frames.feed(data):
+            reply = pickle.loads(body)
+            d = self.pending.popleft()
+            if isinstance(reply, WorkerError):
+                d.errback(reply)
+            else:
+                d.callback(reply)
+
+    def processEnded(self, reason):
+        self.logger.error("Worker process ended: {}".format(reason.getErrorMessage()))
+        self.transport = None
+        while self.pending:
+            self.pending.popleft().errback(WorkerError("worker process ended"))
+
+
+class WorkerPool:
+    """
+    A set of worker processes; new matches go to the one running the fewest.
+    """
+    def __init__(self, count):
+        self.workers = [WorkerProcess(i) for i in range(count)]
+
+    def assign(self):
+        return min(self.workers, key=lambda w: w.matches)
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Blobs game server")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run matches in this many worker processes instead of the reactor process")
+    parser.add_argument("--board-size", type=int, default=BOARD_SIZE,
+                        help="board size for users who don't choose one at login (up to {})".format(MAX_BOARD_SIZE))
+    parser.add_argument("--turn-timeout", type=float, default=TURN_TIMEOUT,
+                        help="seconds to answer your_turn before the turn counts as failed, 0 for no limit")
+    parser.add_argument("--time-budget", type=float, default=MATCH_TIME_BUDGET,
+                        help="chess clock: seconds each user may think during a whole match")
+    parser.add_argument("--metrics", action="store_true",
+                        help="record phase timings and counters, available through get_stats on the spectator port")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve the metrics in the Prometheus text format on this port (implies --metrics)")
+    parser.add_argument("--history-codec", default=HISTORY_CODEC,
+                        help="how board states are stored in match.db: none, or zlib:<level> from 0 to 9")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    try:
+        MatchHistory.codec = stateCodec(args.history_codec)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.worker:
+        # stdout carries the replies, so nothing else may be written to it
+        logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+        MatchWorker().serve(sys.stdin.buffer, sys.stdout.buffer)
+        sys.exit(0)
+
     # create logger
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
@@ -719,9 +3233,16 @@ if __name__ == '__main__':
     #plt.imshow(b.values.astype(np.float64), clim=(0, 10), interpolation="nearest", cmap="hot")
     #plt.show()
 
-    l = Lobby()
+    if not MIN_BOARD_SIZE <= args.board_size <= MAX_BOARD_SIZE:
+        parser.error("--board-size must be between {} and {}".format(MIN_BOARD_SIZE, MAX_BOARD_SIZE))
+    l = Lobby(WorkerPool(args.workers) if args.workers > 0 else None, args.board_size,
+              args.turn_timeout or None, args.time_budget)
     endpoints.serverFromString(reactor, "tcp:1234").listen(l)
     endpoints.serverFromString(reactor, "tcp:9001").listen(SpectatorFactory(l))
+    if args.metrics or args.metrics_port:
+        metrics.enable()
+    if args.metrics_port:
+        endpoints.serverFromString(reactor, "tcp:{}".format(args.metrics_port)).listen(server.Site(MetricsResource()))
     reactor.run()
 
 
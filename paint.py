@@ -10,6 +10,7 @@ from PyQt5.QtGui import QBrush, QColor, QPen, QPixmap, QGuiApplication, QPainter
 from PyQt5.QtCore import Qt, QSize, QRectF, pyqtSignal, pyqtSlot
 from PyQt5 import QtWidgets, QtCore, QtGui
 
+import html
 import json
 import blobs
 
@@ -63,7 +64,10 @@ class GameField:
         scene.render(self.painter, QRectF(10,10,800,800), QRectF(0,0,size,size))
         self.pixmap.save("out/state.png")
 
-    def outputScorePage(self, owners, values, names, ids):
+    def outputScorePage(self, leaderboard):
+        """
+        leaderboard are the entries of a get_leaderboard response.
+        """
         with open('out/index.html', 'w') as f:
             f.write("""<!DOCTYPE HTML PUBLIC \"-//W3C//DTD HTML 4.01//EN\" \"http://www.w3.org/TR/html4/strict.dtd\">\n
                 <html>\n
@@ -101,9 +105,11 @@ class GameField:
                 \t\t\t<tr>\n
                 \t\t\t\t<th>Rank</th>\n
                 \t\t\t\t<th>Bot name</th>\n
-                \t\t\t\t<th>Score</th>\n
+                \t\t\t\t<th>Rating</th>\n
                 \t\t\t</tr>\n""");
-            #TODO: output ramsh here
+            for entry in leaderboard:
+                f.write("\t\t\t<tr><td>{}</td><td>{}</td><td>{:.0f}</td></tr>\n".format(
+                    entry["rank"], html.escape(entry["name"]), entry["rating"]))
             f.write("""\t\t</table>\n
                 \t</body>\n
                 </html>\n""")
@@ -120,7 +126,7 @@ class NetworkInterface(QtCore.QObject):
         PORT = 9001
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((HOST, PORT))
-        self.sock.send(b'{"type": "stream_game"}')
+        self.sock.send(b'{"type": "stream_game"}\n')
 
     @pyqtSlot()
     def run(self):
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Headless tournament runner. Bots are plain Python callables that get called
+in-process instead of connecting to the server:
+
+    def bot(board, slot, rng):
+        return source, dest
+
+board is the live Board of the match (don't modify it), slot the owner value
+of the bot's fields in board.owner and rng a np.random.RandomState seeded per
+game. A bot returns None if it has no legal move; the turn counts as failed.
+Bots are given as "module:function", e.g.
+
+    python simulate.py simulate:randomBot simulate:foodBot --games 50 --processes 4
+"""
+
+import argparse
+import importlib
+import itertools
+import json
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+
+from blobs import Board, Match, Player, Turn, BOARD_SIZE, FOOD_OWNER, MIN_PID
+
+
+def randomBot(board, slot, rng):
+    """
+    Makes a random legal move, None if there is none.
+    """
+    sources, dests = board.legalMoves(slot)
+    if len(sources) == 0:
+        return None
+    i = rng.randint(len(sources))
+    return sources[i], dests[i]
+
+
+def foodBot(board, slot, rng):
+    """
+    Makes the legal move that ends up closest to some food, None if there is
+    no legal move.
+    """
+    sources, dests = board.legalMoves(slot)
+    if len(sources) == 0:
+        return None
+    food = np.argwhere(board.owner == FOOD_OWNER)
+    if len(food) == 0:
+        return randomBot(board, slot, rng)
+    dist = np.abs(dests[:, None, :] - food[None, :, :]).sum(axis=2).min(axis=1)
+    i = rng.choice(np.flatnonzero(dist == dist.min()))
+    return sources[i], dests[i]
+
+
+def loadBot(spec):
+    module, name = spec.split(":")
+    return getattr(importlib.import_module(module), name)
+
+
+class HeadlessMatch(Match):
+    """
+    A match without lobby, spectators or history.
+    """
+    def addStateToHistory(self):
+        # nobody reads the change log
+        self.board.trimChanges(self.board.revision())
+
+
+def playGame(specs, seed, board_size=BOARD_SIZE):
+    """
+    Plays one game between the bots given as "module:function" and returns
+    (index of the winner or None, rounds played).
+    """
+    rng = np.random.RandomState(seed)
+    bots = [loadBot(spec) for spec in specs]
+    players = [Player(MIN_PID + 1 + i, str(i)) for i in range(len(bots))]
+    board = Board(board_size, rng)
+    board.populate(players)
+    match = HeadlessMatch(players, board)
+    while True:
+        player = match.currentUser
+        bot = bots[players.index(player)]
+        try:
+            move = bot(board, board.slotOf(player.connection_id), rng)
+            if move is None:
+                # boxed in, e.g. only fields of strength 1 that would split off
+                ok = False
+                match.skippedTurn()
+            else:
+                ok, message = match.checkedTurn(Turn(move[0], move[1], player))
+        except Exception:
+            logging.getLogger("simulate").exception("Bot {} failed".format(specs[players.index(player)]))
+            ok = False
+            match.current_round += 1
+        player.consecutive_failed_turns = 0 if ok else player.consecutive_failed_turns + 1
+        done, winner = match.checkMatchFinished()
+        if done:
+            break
+        match.nextUser()
+    match.settle()
+    winner = match.history["winner"]
+    return (int(winner) if winner is not None else None), match.current_round
+
+
+def _playJob(job):
+    pairing, specs, seed, board_size = job
+    winner, rounds = playGame(specs, seed, board_size)
+    return pairing, winner, rounds
+
+
+class Tournament:
+    def __init__(self, specs, games=10, seed=0, board_size=BOARD_SIZE, processes=0):
+        self.specs = specs
+        self.games = games
+        self.seed = seed
+        self.board_size = board_size
+        self.pool = multiprocessing.Pool(processes) if processes > 0 else None
+        self.next_seed = seed
+        self.wins = [0] * len(specs)
+        self.draws = [0] * len(specs)
+        self.played = [0] * len(specs)
+        self.points = [0.0] * len(specs)
+        self.opponents = [set() for spec in specs]
+        self.rounds = 0
+        self.elapsed = 0.0
+
+    def playPairings(self, pairings):
+        """
+        Plays self.games games for each (a, b) pairing, swapping who moves first
+        every game.
+        """
+        jobs = []
+        for a, b in pairings:
+            self.opponents[a].add(b)
+            self.opponents[b].add(a)
+            for game in range(self.games):
+                order = (a, b) if game % 2 == 0 else (b, a)
+                jobs.append((order, [self.specs[i] for i in order], self.next_seed, self.board_size))
+                self.next_seed += 1
+        start = time.perf_counter()
+        results = self.pool.imap_unordered(_playJob, jobs) if self.pool else map(_playJob, jobs)
+        for order, winner, rounds in results:
+            self.rounds += rounds
+            for i in order:
+                self.played[i] += 1
+            if winner is None:
+                for i in order:
+                    self.draws[i] += 1
+                    self.points[i] += 0.5
+            else:
+                self.wins[order[winner]] += 1
+                self.points[order[winner]] += 1
+        self.elapsed += time.perf_counter() - start
+
+    def roundRobin(self):
+        self.playPairings(list(itertools.combinations(range(len(self.specs)), 2)))
+
+    def swiss(self, rounds):
+        """
+        Every round pairs bots with equal or similar points that haven't met yet.
+        With an odd number of bots the lowest ranked one sits out and gets the
+        points of a won match.
+        """
+        for round in range(rounds):
+            ranking = sorted(range(len(self.specs)), key=lambda i: -self.points[i])
+            if len(ranking) % 2:
+                bye = ranking.pop()
+                self.points[bye] += self.games
+            pairings = []
+            while ranking:
+                a = ranking.pop(0)
+                b = next((b for b in ranking if b not in self.opponents[a]), ranking[0])
+                ranking.remove(b)
+                pairings.append((a, b))
+            self.playPairings(pairings)
+
+    def report(self):
+        games = sum(self.played) // 2
+        return {
+            "games": games,
+            "seconds": self.elapsed,
+            "games_per_second": games / self.elapsed if self.elapsed else 0.0,
+            "average_rounds": self.rounds / games if games else 0.0,
+            "bots": [{
+                "bot": spec,
+                "played": self.played[i],
+                "wins": self.wins[i],
+                "draws": self.draws[i],
+                "losses": self.played[i] - self.wins[i] - self.draws[i],
+                "points": self.points[i],
+                "win_rate": self.wins[i] / self.played[i] if self.played[i] else 0.0
+            } for i, spec in enumerate(self.specs)]
+        }
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Headless Blobs tournaments")
+    parser.add_argument("bots", nargs="+", help="bots as module:function")
+    parser.add_argument("--format", choices=["round-robin", "swiss"], default="round-robin")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds of a swiss tournament")
+    parser.add_argument("--games", type=int, default=10, help="games per pairing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--board-size", type=int, default=BOARD_SIZE)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="size of the process pool, 0 plays in this process")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+    if len(args.bots) < 2:
+        parser.error("at least two bots are needed")
+
+    logging.basicConfig(level=logging.WARNING)
+    tournament = Tournament(args.bots, args.games, args.seed, args.board_size, args.processes)
+    try:
+        if args.format == "swiss":
+            tournament.swiss(args.rounds)
+        else:
+            tournament.roundRobin()
+    finally:
+        tournament.close()
+    report = tournament.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("{:<30} {:>6} {:>5} {:>5} {:>6} {:>7} {:>8}".format(
+            "bot", "played", "wins", "draws", "losses", "points", "win rate"))
+        for bot in report["bots"]:
+            print("{bot:<30} {played:>6} {wins:>5} {draws:>5} {losses:>6} {points:>7.1f} {win_rate:>8.1%}".format(**bot))
+        print("{games} games in {seconds:.1f}s, {games_per_second:.2f} games/s, {average_rounds:.0f} rounds on average".format(**report))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Tests for the rule engine and the connections. The incremental checks of
+Board and Match are compared against the plain flood fill they replaced, on
+boards from random games.
+
+    python -m pytest -q test_blobs.py
+"""
+
+import json
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from twisted.internet.testing import StringTransport
+
+import blobs
+import simulate
+import wire
+from blobs import Board, Lobby, Match, MatchHistory, Player, SparseGrid, Spectator, Turn, User, \
+    FIRST_PLAYER_SLOT, FOOD_OWNER, MAX_MESSAGE_SIZE, MIN_PID
+
+PLAYERS = 2
+SEEDS = range(8)
+BOARD_SIZE = 16
+TURNS = 300
+
+
+def floodFillContiguous(owner, slot):
+    """
+    The reference: dilates from one field of the player until nothing
+    changes, then tells whether that reached all of the player's fields.
+    """
+    interesting = owner == slot
+    if not interesting.any():
+        return True
+    component = np.zeros(owner.shape, dtype=bool)
+    component[tuple(np.argwhere(interesting)[0])] = True
+    while True:
+        previous = component.copy()
+        component[:, :-1] |= interesting[:, :-1] & component[:, 1:]
+        component[:, 1:] |= interesting[:, 1:] & component[:, :-1]
+        component[:-1, :] |= interesting[:-1, :] & component[1:, :]
+        component[1:, :] |= interesting[1:, :] & component[:-1, :]
+        if (component == previous).all():
+            return (component == interesting).all()
+
+
+def splits(board, pos):
+    """
+    Whether clearing pos splits its owner, according to the reference.
+    """
+    owner = np.array(board.owner)
+    slot = owner[pos]
+    owner[pos] = 0
+    return not floodFillContiguous(owner, slot)
+
+
+def randomGames():
+    """
+    Yields (match, rng) after every turn of a few games played with random
+    legal moves.
+    """
+    for seed in SEEDS:
+        rng = np.random.RandomState(seed)
+        players = [Player(MIN_PID + 1 + i, str(i)) for i in range(PLAYERS)]
+        board = Board(BOARD_SIZE, rng)
+        board.populate(players)
+        match = Match(players, board)
+        for turn in range(TURNS):
+            yield match, rng
+            player = match.currentUser
+            sources, dests = match.legalMoves(player)
+            if len(sources):
+                i = rng.randint(len(sources))
+                match.checkedTurn(Turn(tuple(sources[i]), tuple(dests[i]), player))
+            if match.checkMatchFinished()[0]:
+                break
+            match.nextUser()
+
+
+class ContiguityTest(unittest.TestCase):
+    def testIsArticulation(self):
+        checked = 0
+        for match, rng in randomGames():
+            board = match.board
+            for slot in board.players():
+                for x, y in np.argwhere(board.owner == slot):
+                    pos = int(x), int(y)
+                    self.assertEqual(board.isArticulation(pos), splits(board, pos), pos)
+                    checked += 1
+        self.assertGreater(checked, 0)
+
+    def testCheckTurnSplit(self):
+        checked = 0
+        for match, rng in randomGames():
+            board = match.board
+            player = match.currentUser
+            slot = board.slotOf(player.connection_id)
+            for x, y in np.argwhere((board.owner == slot) & (board.values == 1)):
+                source = int(x), int(y)
+                for dest in board.neighbors(source) + [tuple(rng.randint(BOARD_SIZE, size=2))]:
+                    ok, message = match.checkTurn(Turn(source, dest, player))
+                    if ok or message == "you would split yourself":
+                        self.assertEqual(not ok, splits(board, source), (source, dest))
+                        checked += 1
+        self.assertGreater(checked, 0)
+
+    def testComponents(self):
+        for match, rng in randomGames():
+            board = match.board
+            for slot in range(FIRST_PLAYER_SLOT, FIRST_PLAYER_SLOT + PLAYERS):
+                self.assertEqual(board.playerContiguous(slot), floodFillContiguous(np.array(board.owner), slot))
+
+
+def connect(protocol, binary=False):
+    protocol.makeConnection(StringTransport())
+    if binary:
+        protocol.switchToBinary(False)
+    return protocol
+
+
+def frame(message):
+    return wire.encodeFrame(message)
+
+
+def received(protocol):
+    """
+    Returns the messages written to the protocol's transport since the last call.
+    """
+    data = protocol.transport.value()
+    protocol.transport.clear()
+    if protocol.frames is not None:
+        return [wire.decodeFrame(body) for body in wire.FrameReader().feed(data)]
+    return [json.loads(line) for line in data.decode("utf8").splitlines()]
+
+
+class ConnectionTest(unittest.TestCase):
+    def testDisconnectWhilePaused(self):
+        # the transport's buffer is full, the final message only adds to it
+        user = connect(User(MIN_PID + 1, ("test", 0), None))
+        user.pauseProducing()
+        user.matchFinished(None)
+        self.assertTrue(user.transport.disconnecting)
+        self.assertIsNone(user.transport.producer)
+
+    def testBadFrameKeepsFollowingFrames(self):
+        spectator = connect(Spectator(None, ("test", 0)), binary=True)
+        broken = frame({"type": "replay_match"})[:-1] + b"{"
+        spectator.dataReceived(broken + frame({"type": "no_such_request"}))
+        messages = received(spectator)
+        self.assertEqual([m["status"] for m in messages], ["failure", "failure"])
+        self.assertEqual(messages[1]["message"], "Unknown request.")
+        self.assertFalse(spectator.transport.disconnecting)
+
+    def testFramingErrorDisconnects(self):
+        spectator = connect(Spectator(None, ("test", 0)), binary=True)
+        spectator.dataReceived(wire.PREFIX.pack(MAX_MESSAGE_SIZE + 1) + frame({"type": "no_such_request"}))
+        self.assertEqual(len(received(spectator)), 1)
+        self.assertTrue(spectator.transport.disconnecting)
+        self.assertIsNone(spectator.transport.producer)
+
+    def testSetProtocol(self):
+        for protocol in (User(MIN_PID + 1, ("test", 0), None), Spectator(None, ("test", 0))):
+            transport = connect(protocol).transport
+            # each response still goes out in the framing the request came in
+            protocol.dataReceived(b'{"type": "set_protocol", "protocol": "binary"}\n')
+            self.assertIsNotNone(protocol.frames)
+            self.assertEqual(json.loads(transport.value())["status"], "success")
+            transport.clear()
+            protocol.dataReceived(frame({"type": "set_protocol", "protocol": "json"}))
+            self.assertIsNone(protocol.frames)
+            body, = wire.FrameReader().feed(transport.value())
+            self.assertEqual(wire.decodeFrame(body)["status"], "success")
+            transport.clear()
+            protocol.dataReceived(b'{"type": "set_protocol", "protocol": "xml"}\n')
+            self.assertEqual([m["message"] for m in received(protocol)], ["Unknown protocol."])
+
+
+class RequeueTest(unittest.TestCase):
+    def setUp(self):
+        # the lobby keeps its users and matches in the working directory
+        self.cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp())
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+    def send(self, user, message):
+        user.dataReceived((json.dumps(message) + "\n").encode("utf8"))
+
+    def failTurn(self, users):
+        user, = [u for u in users if u.network_state == "game_your_turn"]
+        self.send(user, {"type": "move", "from": [-1, -1], "to": [0, 0]})
+        return user
+
+    @mock.patch.object(blobs, "MAX_CONSECUTIVE_FAILS", 3)
+    def testFailedTurnsDontCarryOver(self):
+        lobby = Lobby()
+        users = []
+        for i in range(2):
+            user = connect(lobby.buildProtocol(("test", i)))
+            self.send(user, {"type": "register", "user": "u{}".format(i), "password": "x"})
+            self.send(user, {"type": "login", "user": "u{}".format(i), "password": "x", "requeue": True})
+            users.append(user)
+        first, = lobby.activeMatches
+        while first in lobby.activeMatches:
+            self.failTurn(users)
+        self.assertEqual(lobby.history.matchCount(), 1)
+        second, = lobby.activeMatches
+        self.assertIsNot(second, first)
+        self.assertEqual([u.consecutive_failed_turns for u in users], [0, 0])
+        user = self.failTurn(users)
+        self.assertIn(second, lobby.activeMatches)
+        self.assertEqual(user.consecutive_failed_turns, 1)
+        self.assertEqual(user.turn_seq, 1)
+
+
+class HistoryTest(unittest.TestCase):
+    @mock.patch.object(blobs, "DENSE_BOARD_SIZE", BOARD_SIZE - 1)
+    def testSparseStateAt(self):
+        rng = np.random.RandomState(0)
+        players = [Player(MIN_PID + 1 + i, str(i)) for i in range(PLAYERS)]
+        board = Board(BOARD_SIZE, rng)
+        board.populate(players)
+        match = Match(players, board)
+        self.assertTrue(board.sparse)
+        states = []
+        for turn in range(TURNS):
+            states.append((np.array(board.values), board.ownerIds(board.owner)))
+            player = match.currentUser
+            sources, dests = match.legalMoves(player)
+            i = rng.randint(len(sources))
+            match.checkedTurn(Turn(tuple(sources[i]), tuple(dests[i]), player))
+            if match.checkMatchFinished()[0]:
+                break
+            match.nextUser()
+        for turn in (0, len(states) // 2, len(states) - 1):
+            values, owner = MatchHistory.stateAt(match.history, turn)
+            self.assertIsInstance(values, SparseGrid)
+            self.assertTrue((np.array(values) == states[turn][0]).all(), turn)
+            self.assertTrue((np.array(owner) == states[turn][1]).all(), turn)
+
+
+def passBot(board, slot, rng):
+    return None
+
+
+class SimulateTest(unittest.TestCase):
+    def testNoLegalMove(self):
+        board = Board(BOARD_SIZE)
+        slot = board.addPlayer(MIN_PID + 1)
+        # a field without strength can't move
+        board.setField((3, 3), slot, 0)
+        board.setField((5, 5), FOOD_OWNER, 1)
+        rng = np.random.RandomState(0)
+        self.assertIsNone(simulate.randomBot(board, slot, rng))
+        self.assertIsNone(simulate.foodBot(board, slot, rng))
+
+    def testPassingCountsAsFailedTurn(self):
+        with self.assertNoLogs("simulate", logging.ERROR):
+            winner, rounds = simulate.playGame(["test_blobs:passBot", "simulate:randomBot"], 0, BOARD_SIZE)
+        self.assertEqual(winner, 1)
+        self.assertLess(rounds, 2 * blobs.MAX_CONSECUTIVE_FAILS + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
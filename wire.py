@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Binary framing for bot and spectator connections, negotiated with a
+{"type": "set_protocol", "protocol": "binary"} request. JSON lines stay the default.
+
+Every frame is a 4 byte big endian length followed by that many bytes:
+    uint8 flags, uint32 length of the JSON part
+    the JSON message (utf8)
+    the raw array payload, zlib compressed if FLAG_ZLIB is set
+The JSON message lists the appended arrays under "arrays" as [name, dtype, shape]
+entries; decodeFrame() puts them back into the message as NumPy arrays.
+"""
+
+import json
+import struct
+import zlib
+
+import numpy as np
+
+FLAG_ZLIB = 1
+
+# bytes of array data a frame may decode to, see decodeFrame()
+MAX_PAYLOAD = 2**26
+
+PREFIX = struct.Struct("!I")
+HEADER = struct.Struct("!BI")
+
+
+class FrameError(Exception):
+    pass
+
+
+def encodeFrame(message, arrays=None, compress=False):
+    """
+    Builds a complete frame, including the length prefix, from a JSON-serializable
+    message and an optional dict of NumPy arrays.
+    """
+    flags = 0
+    payload = b""
+    if arrays:
+        message = dict(message)
+        message["arrays"] = [[name, a.dtype.str, list(a.shape)] for name, a in arrays.items()]
+        payload = b"".join(np.ascontiguousarray(a).tobytes() for a in arrays.values())
+        if compress:
+            payload = zlib.compress(payload, 1)
+            flags |= FLAG_ZLIB
+    text = json.dumps(message).encode("utf8")
+    body = HEADER.pack(flags, len(text)) + text + payload
+    return PREFIX.pack(len(body)) + body
+
+
+def decodeFrame(body, max_payload=MAX_PAYLOAD):
+    """
+    Decodes the body of a frame (without the length prefix) into a message dict.
+    The arrays may take up to max_payload bytes, and a compressed payload is
+    never inflated beyond the size of the arrays it declares.
+    """
+    if len(body) < HEADER.size:
+        raise FrameError("frame too short")
+    flags, length = HEADER.unpack_from(body)
+    start = HEADER.size
+    if start + length > len(body):
+        raise FrameError("JSON part exceeds frame")
+    message = json.loads(body[start:start+length].decode("utf8"))
+    layout = message.pop("arrays", None) if isinstance(message, dict) else None
+    if layout:
+        if any(int(n) < 0 for name, dtype, shape in layout for n in shape):
+            raise FrameError("negative array shape")
+        layout = [(name, np.dtype(dtype), shape, int(np.prod(shape, dtype=np.int64))) for name, dtype, shape in layout]
+        size = sum(count * dtype.itemsize for name, dtype, shape, count in layout)
+        if size > max_payload:
+            raise FrameError("arrays of {} bytes exceed the limit".format(size))
+        payload = body[start+length:]
+        if flags & FLAG_ZLIB:
+            decompressor = zlib.decompressobj()
+            try:
+                # a max_length of 0 would mean no limit
+                payload = decompressor.decompress(payload, max(size, 1))
+            except zlib.error as e:
+                raise FrameError("bad compressed payload: {}".format(e))
+            if decompressor.unconsumed_tail or len(payload) > size:
+                raise FrameError("compressed payload exceeds its arrays")
+        offset = 0
+        for name, dtype, shape, count in layout:
+            if offset + count * dtype.itemsize > len(payload):
+                raise FrameError("array '{}' exceeds payload".format(name))
+            message[name] = np.frombuffer(payload, dtype, count, offset).reshape(shape)
+            offset += count * dtype.itemsize
+    return message
+
+
+class FrameReader:
+    """
+    Splits a byte stream into frame bodies. push() buffers data, pop() returns
+    the next complete body or None; feed() does both and returns all bodies
+    completed by the new data.
+    """
+    def __init__(self, max_length=2**26):
+        self.buffer = b""
+        self.max_length = max_length
+
+    def push(self, data):
+        self.buffer += data
+
+    def pop(self):
+        if len(self.buffer) < PREFIX.size:
+            return None
+        length, = PREFIX.unpack_from(self.buffer)
+        if length > self.max_length:
+            raise FrameError("frame of {} bytes exceeds the limit".format(length))
+        if len(self.buffer) < PREFIX.size + length:
+            return None
+        body = self.buffer[PREFIX.size:PREFIX.size+length]
+        self.buffer = self.buffer[PREFIX.size+length:]
+        return body
+
+    def feed(self, data):
+        self.push(data)
+        bodies = []
+        body = self.pop()
+        while body is not None:
+            bodies.append(body)
+            body = self.pop()
+        return bodies